@@ -1,3 +1,5 @@
+from itertools import chain
+
 import numpy as np
 import torchvision.transforms as transforms
 from PIL import Image, ImageDraw
@@ -6,33 +8,49 @@ IMAGE_SIZE = 64
 
 
 def strokes_to_grayscale_image(stroke_data: list[list[tuple[int, int]]], image_size: int):
+    offsets = np.zeros(len(stroke_data) + 1, dtype=np.int64)
+    np.cumsum([len(stroke) for stroke in stroke_data], out=offsets[1:])
+    coordinates = chain.from_iterable(chain.from_iterable(stroke_data))
+    points = np.fromiter(coordinates, dtype=np.float64).reshape(-1, 2)
+    return points_to_grayscale_image(points, offsets, image_size)
+
+
+def points_to_grayscale_image(points: np.ndarray, offsets: np.ndarray, image_size: int):
+    """
+    Render packed strokes, see pack_strokes, to a grayscale image.
+
+    :param points: Array of shape (N, 2) with the points of all strokes, in 0-1000 space.
+    :param offsets: Array of shape (S + 1,) with the stroke boundaries.
+    :param image_size: Size of the generated image (the image is square).
+    :return: The image as a uint8 array, black strokes on a white background.
+    """
     # Create the Pillow version
     img_pil = Image.new("L", (image_size, image_size), 255)  # 'L' mode for grayscale
     draw = ImageDraw.Draw(img_pil)
 
     # Scale down the strokes to fit the image size, adding an extra 5% padding.
+    # All strokes are scaled in one go, rounding half to even like round() does.
     padding = 0.10
     scale = (image_size * (1 - padding)) / 1000
     offset = (image_size * padding) / 2
-    stroke_data = [
-        [(round(point[0] * scale + offset), round(point[1] * scale + offset)) for point in stroke]
-        for stroke in stroke_data
-    ]
+    pixels = np.round(points * scale + offset).astype(np.int64)
 
     # Clear out duplicate consecutive points, so that they can be detected as single points.
     # Otherwise, a short segment could be scaled down to a single point, and then
     # not get the point handling treatment, resulting in nothing being drawn.
-    for stroke in stroke_data:
-        for i in range(len(stroke) - 1, 0, -1):
-            if stroke[i] == stroke[i - 1]:
-                stroke.pop(i)
-
-    # Iterate through each stroke and draw it
-    for stroke in stroke_data:
-        if len(stroke) == 1:
+    keep = np.ones(len(pixels), dtype=bool)
+    keep[1:] = np.any(pixels[1:] != pixels[:-1], axis=1)
+    starts = offsets[:-1]
+    keep[starts[starts < len(pixels)]] = True
+    pixels = pixels[keep]
+    offsets = np.concatenate(([0], np.cumsum(keep)))[offsets].tolist()
+
+    # Iterate through each stroke and draw it, each as a single polyline.
+    for start, end in zip(offsets, offsets[1:]):
+        stroke = pixels[start:end].ravel().tolist()
+        if len(stroke) == 2:
             # Handle single point by adding a second point offset by 1
-            point = stroke[0]
-            stroke.append((point[0] + 1, point[1] + 1))
+            stroke += [stroke[0] + 1, stroke[1] + 1]
 
         draw.line(stroke, fill=0, width=1)
 
@@ -166,6 +184,20 @@ def skew_matrix(skew_x: float, skew_y: float, image_size: int = 1000) -> np.ndar
     return transformation
 
 
+def combine_transformations(transformations: list[np.ndarray]) -> np.ndarray:
+    """
+    Combine a sequence of transformation matrices into a single matrix.
+    Transformations are applied in the ascending order they are provided.
+
+    :param transformations: List of 3x3 transformation matrices.
+    :return: The combined 3x3 transformation matrix.
+    """
+    total_transformation = np.eye(3)
+    for transformation in transformations:
+        total_transformation = transformation @ total_transformation
+    return total_transformation
+
+
 def apply_transformations(
     stroke_data: list[list[tuple[int, int]]],
     transformations: list[np.ndarray] | np.ndarray,
@@ -183,6 +215,33 @@ def apply_transformations(
     :param image_size: [Optional] Size of the image the strokes are drawn on.
     :return: Transformed stroke data.
     """
+    # Flatten all strokes into a single array and keep track of stroke lengths.
+    points = np.array([point for stroke in stroke_data for point in stroke]).reshape(-1, 2)
+    offsets = np.cumsum([0] + [len(stroke) for stroke in stroke_data])
+
+    transformed_points = apply_transformations_to_points(
+        points, transformations, shuffle_transformations, image_size
+    )
+
+    # Split the transformed points back into strokes.
+    return unpack_strokes(transformed_points, offsets)
+
+
+def apply_transformations_to_points(
+    points: np.ndarray,
+    transformations: list[np.ndarray] | np.ndarray,
+    shuffle_transformations: bool = False,
+    image_size: int = 1000,
+) -> np.ndarray:
+    """
+    Same as apply_transformations, but for the packed points of all strokes, see pack_strokes.
+
+    :param points: Array of shape (N, 2) with the points of all strokes.
+    :param transformations: List of 3x3 transformation matrices to apply.
+    :param shuffle_transformations: [Optional] If True, shuffle the order of transformations.
+    :param image_size: [Optional] Size of the image the strokes are drawn on.
+    :return: Integer array of shape (N, 2) with the transformed points.
+    """
     if not isinstance(transformations, list):
         transformations = [transformations]
 
@@ -191,29 +250,20 @@ def apply_transformations(
         generator = np.random.default_rng()
         generator.shuffle(transformations)
 
-    # Combine all transformation matrices into a single matrix
-    total_transformation = np.eye(3)
-    for transformation in transformations:
-        total_transformation = transformation @ total_transformation
-
-    # Flatten all strokes into a single array and keep track of stroke lengths.
-    all_points = []
-    stroke_lengths = []
-    for stroke in stroke_data:
-        all_points.extend(stroke)
-        stroke_lengths.append(len(stroke))
+    total_transformation = combine_transformations(transformations)
 
-    points_array = np.array(all_points)
-    ones = np.ones((points_array.shape[0], 1))
-    homogeneous_points = np.hstack([points_array, ones])
+    # Work on the coordinates as rows, so that the bounding box reductions run over
+    # contiguous memory. Only the x and y rows of the result are needed.
+    homogeneous_points = np.empty((3, points.shape[0]))
+    homogeneous_points[:2] = points.T
+    homogeneous_points[2] = 1
 
-    transformed_points = homogeneous_points @ total_transformation.T
-    x_new, y_new = transformed_points[:, 0], transformed_points[:, 1]
+    transformed_points = total_transformation[:2] @ homogeneous_points
 
     # Calculate the bounding box of the transformed points.
     # We may need to scale the image down to fit again.
-    min_x, min_y = x_new.min(), y_new.min()
-    max_x, max_y = x_new.max(), y_new.max()
+    min_x, min_y = transformed_points.min(axis=1).tolist()
+    max_x, max_y = transformed_points.max(axis=1).tolist()
 
     width, height = max_x - min_x, max_y - min_y
     if width == 0 or height == 0:
@@ -222,34 +272,56 @@ def apply_transformations(
         scale = min(image_size / width, image_size / height)
 
     if scale < 1:
-        tx = (1 - scale) * image_size / 2
-        ty = (1 - scale) * image_size / 2
-        scaling_matrix = np.array(
-            [
-                [scale, 0, tx],
-                [0, scale, ty],
-                [0, 0, 1],
-            ]
-        )
+        # Scale down around the center of the image, in place rather than with another matrix.
+        translation = (1 - scale) * image_size / 2
+        transformed_points *= scale
+        transformed_points += translation
 
-        ones = np.ones((transformed_points.shape[0], 1))
-        transformed_points = np.hstack([transformed_points[:, :2], ones])
-        scaled_points = transformed_points @ scaling_matrix.T
-        x_scaled = np.round(scaled_points[:, 0]).astype(int)  # Replace with x_new??
-        y_scaled = np.round(scaled_points[:, 1]).astype(int)
-    else:
-        x_scaled = np.round(x_new).astype(int)
-        y_scaled = np.round(y_new).astype(int)
+    return np.round(transformed_points).T.astype(int, order="C")
 
-    # Split the transformed points back into strokes.
-    transformed_strokes = []
-    idx = 0
-    for length in stroke_lengths:
-        stroke_points = list(zip(x_scaled[idx : idx + length], y_scaled[idx : idx + length]))
-        transformed_strokes.append(stroke_points)
-        idx += length
 
-    return transformed_strokes
+def pack_strokes(stroke_data: list[list[tuple[int, int]]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pack the stroke data into a single contiguous array of points, plus the stroke boundaries.
+    The points of stroke i are points[offsets[i] : offsets[i + 1]].
+
+    :param stroke_data: List of strokes, each stroke being a list of points.
+    :return: An int16 array of shape (N, 2) and an int32 array of shape (S + 1,).
+    """
+    offsets = np.zeros(len(stroke_data) + 1, dtype=np.int32)
+    np.cumsum([len(stroke) for stroke in stroke_data], out=offsets[1:])
+    points = np.array(
+        [point for stroke in stroke_data for point in stroke], dtype=np.int16
+    ).reshape(-1, 2)
+    return points, offsets
+
+
+def unpack_strokes(points: np.ndarray, offsets: np.ndarray) -> list[list[list[int]]]:
+    """
+    Inverse of pack_strokes.
+
+    :param points: Array of shape (N, 2) with the points of all strokes.
+    :param offsets: Array of shape (S + 1,) with the stroke boundaries.
+    :return: List of strokes, each stroke being a list of points.
+    """
+    offsets = offsets.tolist()
+    return [points[start:end].tolist() for start, end in zip(offsets, offsets[1:])]
+
+
+def concatenate_strokes(
+    *packed_strokes: tuple[np.ndarray, np.ndarray]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Join several packed stroke sets into one, see pack_strokes.
+
+    :param packed_strokes: The (points, offsets) pairs to join, in order.
+    :return: The joined points and offsets.
+    """
+    points = np.concatenate([points for points, _ in packed_strokes])
+    offsets = [packed_strokes[0][1]]
+    for _, next_offsets in packed_strokes[1:]:
+        offsets.append(next_offsets[1:] + offsets[-1][-1])
+    return points, np.concatenate(offsets)
 
 
 def tensorize_strokes(stroke_data: list[list[tuple[int, int]]], image_size: int):
@@ -292,44 +364,65 @@ def augment_strokes_with_perlin(
     Returns:
     - List of augmented strokes with distorted coordinates.
     """
+    points = np.array([point for stroke in strokes for point in stroke]).reshape(-1, 2)
+    offsets = np.cumsum([0] + [len(stroke) for stroke in strokes])
+    distorted_points = augment_points_with_perlin(
+        points, scale, amplitude, octaves, persistence, lacunarity, seed
+    )
+    return unpack_strokes(distorted_points, offsets)
+
+
+def augment_points_with_perlin(
+    points: np.ndarray,
+    scale: float = 1000.0,
+    amplitude: float = 150.0,
+    octaves: int = 3,
+    persistence: float = 0.5,
+    lacunarity: float = 2.0,
+    seed: int = 42,
+) -> np.ndarray:
+    """
+    Same as augment_strokes_with_perlin, but for the packed points of all strokes,
+    see pack_strokes.
+
+    :param points: Array of shape (N, 2) with the points of all strokes.
+    :return: Integer array of shape (N, 2) with the distorted points.
+    """
     # This dependency is only needed for training.
     # This way the file can still be used for inference without the dependency.
     from noise import pnoise2
 
-    distorted_strokes = []
-
-    for stroke in strokes:
-        distorted_stroke = []
-        for x, y in stroke:
-            # Normalize the coordinates to the scale of the noise
-            noise_x = pnoise2(
-                x / scale,
-                y / scale,
-                octaves=octaves,
-                persistence=persistence,
-                lacunarity=lacunarity,
-                repeatx=1000,  # Match canvas size for seamless noise
-                repeaty=1000,
-                base=seed,
-            )
-
-            noise_y = pnoise2(
-                y / scale,
-                x / scale,  # Swap x and y for variety in distortion
-                octaves=octaves,
-                persistence=persistence,
-                lacunarity=lacunarity,
-                repeatx=1000,
-                repeaty=1000,
-                base=seed + 1,  # Slightly different seed for y-axis noise
-            )
-
-            # Apply the noise as a distortion
-            new_x = x + amplitude * noise_x
-            new_y = y + amplitude * noise_y
-
-            distorted_stroke.append([int(new_x), int(new_y)])
-
-        distorted_strokes.append(distorted_stroke)
-
-    return distorted_strokes
+    # pnoise2 adds the base to indices into its 512 entry permutation table, which can already
+    # reach 510, so any base above 1 reads past its end and gives different results from one
+    # process to the next. Keep the bases at 0 and 1, and use the low 16 bits of the seed to
+    # shift the coordinates by whole lattice cells instead, one byte for each axis.
+    shift_x = seed & 255
+    shift_y = (seed >> 8) & 255
+
+    noise = np.empty((points.shape[0], 2))
+    for i, (x, y) in enumerate(points.tolist()):
+        # Normalize the coordinates to the scale of the noise
+        noise[i, 0] = pnoise2(
+            x / scale + shift_x,
+            y / scale + shift_y,
+            octaves=octaves,
+            persistence=persistence,
+            lacunarity=lacunarity,
+            repeatx=1000,  # Match canvas size for seamless noise
+            repeaty=1000,
+            base=0,
+        )
+
+        noise[i, 1] = pnoise2(
+            y / scale + shift_x,
+            x / scale + shift_y,  # Swap x and y for variety in distortion
+            octaves=octaves,
+            persistence=persistence,
+            lacunarity=lacunarity,
+            repeatx=1000,
+            repeaty=1000,
+            base=1,  # Slightly different seed for y-axis noise
+        )
+
+    # Apply the noise as a distortion
+    return (points + amplitude * noise).astype(int)
@@ -1,3 +1,4 @@
+import os
 import sys
 from importlib import resources
 from pathlib import Path
@@ -133,11 +134,11 @@ def open_file(path: Path) -> None:
     Open any given file with the default application.
     """
     logger.debug(f"Opening file {path}")
-    try:
-        # Use Qt to open the file, so that it works on all platforms.
-        Qg.QDesktopServices.openUrl(Qc.QUrl.fromLocalFile(str(path)))
-    except Exception:
-        show_exception(None, "File Error", "Failed to open file.")
+    # Use Qt to open the file, so that it works on all platforms.
+    # Qt reports failure through the return value, it doesn't raise.
+    if not Qg.QDesktopServices.openUrl(Qc.QUrl.fromLocalFile(os.fspath(path))):
+        logger.error(f"Failed to open file {path}")
+        show_warning(None, "File Error", "Failed to open file.")
 
 
 # Mapping between KDE color keys and QPalette roles
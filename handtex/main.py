@@ -52,8 +52,8 @@ def main() -> None:
 
     sys.excepthook = exception_handler
 
-    # Dump the system info.
-    logger.info(ut.collect_system_info(__file__))
+    # Dump the system info. This is only collected if a sink actually logs it.
+    logger.opt(lazy=True).info("{}", lambda: ut.collect_system_info(__file__))
 
     # Dump the command line arguments if in debug mode.
     if args.debug:
@@ -2,6 +2,7 @@ import PySide6.QtCore as Qc
 import PySide6.QtGui as Qg
 import PySide6.QtWidgets as Qw
 from PySide6.QtCore import Signal
+import numpy as np
 from loguru import logger
 from rdp import rdp
 
@@ -321,29 +322,52 @@ def rescale_and_center_viewport(
     :param viewport_height: The height of the viewport.
     :return: The transformed coordinates, the scaling factor, and the x and y offset.
     """
+    # Pack the strokes, so that the fit is computed the same way as for rescale_and_center_points.
+    offsets = np.cumsum([0] + [len(stroke) for stroke in coordinates]).tolist()
+    points = np.array(
+        [point for stroke in coordinates for point in stroke], dtype=np.float64
+    ).reshape(-1, 2)
+
+    centered_points, scale, offset_x, offset_y = rescale_and_center_points(
+        points, viewport_width, viewport_height
+    )
+
+    centered_points = [tuple(point) for point in centered_points.tolist()]
+    if len(centered_points) == 1:
+        # A single point is returned as a single stroke, dropping any empty ones.
+        return [centered_points], scale, offset_x, offset_y
+    centered_coords = [centered_points[start:end] for start, end in zip(offsets, offsets[1:])]
+    return centered_coords, scale, offset_x, offset_y
+
+
+def rescale_and_center_points(
+    points: np.ndarray, viewport_width: float, viewport_height: float
+) -> tuple[np.ndarray, float, int, int]:
+    """
+    Same as rescale_and_center_viewport, but for the packed points of all strokes.
+    See handtex.detector.image_gen.pack_strokes for the layout.
+
+    :param points: Array of shape (N, 2) with the points of all strokes.
+    :param viewport_width: The width of the viewport.
+    :param viewport_height: The height of the viewport.
+    :return: The transformed points, the scaling factor, and the x and y offset.
+    """
     # Step 1: Rescale the viewport
     initial_scale = CANVAS_SIZE / max(viewport_width, viewport_height)
-
-    scaled_coordinates = []
-    for sublist in coordinates:
-        scaled_sublist = [(x * initial_scale, y * initial_scale) for x, y in sublist]
-        scaled_coordinates.append(scaled_sublist)
+    scaled_points = points * initial_scale
 
     # Step 2: Scale and center the rescaled coordinates
-    all_points = [point for sublist in scaled_coordinates for point in sublist]
-
-    if len(all_points) == 1:
+    if len(scaled_points) == 1:
+        x, y = scaled_points[0].tolist()
         return (
-            [[(CANVAS_SIZE // 2, CANVAS_SIZE // 2)]],
+            np.array([[CANVAS_SIZE // 2, CANVAS_SIZE // 2]]),
             1,
-            CANVAS_SIZE / 2 - all_points[0][0],
-            CANVAS_SIZE / 2 - all_points[0][1],
+            CANVAS_SIZE / 2 - x,
+            CANVAS_SIZE / 2 - y,
         )
 
-    xs, ys = zip(*all_points)
-
-    min_x, max_x = min(xs), max(xs)
-    min_y, max_y = min(ys), max(ys)
+    min_x, min_y = scaled_points.min(axis=0).tolist()
+    max_x, max_y = scaled_points.max(axis=0).tolist()
 
     width, height = max_x - min_x, max_y - min_y
 
@@ -357,14 +381,9 @@ def rescale_and_center_viewport(
     offset_y = round((CANVAS_SIZE - height * scale_factor) / 2 - min_y * scale_factor)
 
     # Scale and center all coordinates
-    centered_coords = []
-    for sublist in scaled_coordinates:
-        centered_sublist = [
-            (int(x * scale_factor + offset_x), int(y * scale_factor + offset_y)) for x, y in sublist
-        ]
-        centered_coords.append(centered_sublist)
-
-    return centered_coords, initial_scale * scale_factor, offset_x, offset_y
+    centered_points = (scaled_points * scale_factor + (offset_x, offset_y)).astype(int)
+
+    return centered_points, initial_scale * scale_factor, offset_x, offset_y
 
 
 def scale_correction_function(x: float) -> float:
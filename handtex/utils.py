@@ -1,14 +1,16 @@
 import difflib
+import itertools
 import tarfile
 import time
 import os
 import platform
+import re
 import shutil
 import sys
+from functools import cache, lru_cache
 from importlib import resources
-from io import StringIO
 from pathlib import Path
-from typing import get_type_hints, Generic, TypeVar, Optional
+from typing import get_type_hints, get_origin, Generic, TypeVar, Optional, Iterator
 
 import PySide6
 import PySide6.QtCore as Qc
@@ -29,83 +31,107 @@ import handtex.data.custom_icons
 
 T = TypeVar("T")
 
+# The platform can't change while we're running, so only ask once.
+_SYSTEM = platform.system()
+
 
 class Shared(Generic[T]):
+    """
+    A mutable box around a single value, so that it can be shared by reference.
+    """
+
+    __slots__ = ("_value",)
+
     def __init__(self, initial_value: Optional[T] = None) -> None:
-        self._container = {"data": initial_value}
+        self._value = initial_value
 
     def get(self) -> Optional[T]:
-        return self._container["data"]
+        return self._value
 
     def set(self, value: T) -> None:
-        self._container["data"] = value
+        self._value = value
 
     def is_none(self) -> bool:
-        return self._container["data"] is None
+        return self._value is None
 
 
+# Matches either a [Section] header or a Key=Value pair on a line of a theme file.
+_THEME_LINE_RE = re.compile(
+    r"^[ \t]*(?:"
+    r"\[(?P<section>[^\r\n]+)\]"
+    r"|(?P<key>[^=\s]+)[ \t]*=[ \t]*(?P<value>[^\r\n]*?)"
+    r")\s*?$",
+    re.MULTILINE,
+)
+_THEME_GENERAL_SECTION_RE = re.compile(r"^[ \t]*\[General\]\s*?$", re.MULTILINE)
+
 # Logging session markers.
 STARTUP_MESSAGE = "---- Starting up ----"
 SHUTDOWN_MESSAGE = "---- Shutting down ----"
 
 
+@cache
 def running_in_flatpak() -> bool:
     return Path("/.flatpak-info").exists()
 
 
 def collect_system_info(callers_file: str) -> str:
-    buffer = StringIO()
-    buffer.write("\n" + STARTUP_MESSAGE)
-    buffer.write("\n- Program Information -\n")
-    buffer.write(f"Program: {__program__} {__version__}\n")
-    buffer.write(f"Executing from: {callers_file}\n")
-    buffer.write(f"Log file: {get_log_path()}\n")
-    buffer.write(f"Config file: {get_config_path()}\n")
-    buffer.write(f"Cache directory: {get_cache_path()}\n")
-    buffer.write("- System Information -\n")
-    buffer.write(f"Operating System: {platform.system()} {platform.release()}\n")
-    if platform.system() == "Linux":
-        buffer.write(f"Desktop Environment: {os.getenv('XDG_CURRENT_DESKTOP', 'unknown')}\n")
-    if running_in_flatpak():
-        buffer.write("Sandbox: Running in Flatpak\n")
-    buffer.write(f"Machine: {platform.machine()}\n")
-    buffer.write(f"Python Version: {sys.version}\n")
-    buffer.write(f"PySide (Qt) Version: {PySide6.__version__}\n")
-    buffer.write(f"Available Qt Themes: {', '.join(Qw.QStyleFactory.keys())}\n")
     current_app_theme = Qw.QApplication.style()
     current_app_theme_name = (
         current_app_theme.objectName() if current_app_theme else "System Default"
     )
-    buffer.write(f"Current Qt Theme: {current_app_theme_name}\n")
     icon_theme_name = Qg.QIcon.themeName()
     icon_theme_name = icon_theme_name if icon_theme_name else "System Default"
-    buffer.write(f"Current Icon Theme: {icon_theme_name}\n")
-    buffer.write(
-        f"Available Color Themes: {', '.join(map(lambda a: a[1], get_available_themes()))}\n"
-    )
-    buffer.write(f"System locale: {Qc.QLocale.system().name()}\n")
-    buffer.write(f"CPU Cores: {os.cpu_count()}\n")
-    buffer.write(f"Memory: {sys_virtual_memory_total() / 1024 ** 3:.2f} GiB\n")
-    buffer.write(f"Swap: {sys_swap_memory_total() / 1024 ** 3:.2f} GiB\n")
-
-    return buffer.getvalue()
-
 
+    parts: list[str] = [
+        "\n" + STARTUP_MESSAGE,
+        "\n- Program Information -\n",
+        f"Program: {__program__} {__version__}\n",
+        f"Executing from: {callers_file}\n",
+        f"Log file: {get_log_path()}\n",
+        f"Config file: {get_config_path()}\n",
+        f"Cache directory: {get_cache_path()}\n",
+        "- System Information -\n",
+        f"Operating System: {_SYSTEM} {platform.release()}\n",
+    ]
+    if _SYSTEM == "Linux":
+        parts.append(f"Desktop Environment: {os.getenv('XDG_CURRENT_DESKTOP', 'unknown')}\n")
+    if running_in_flatpak():
+        parts.append("Sandbox: Running in Flatpak\n")
+    parts += [
+        f"Machine: {platform.machine()}\n",
+        f"Python Version: {sys.version}\n",
+        f"PySide (Qt) Version: {PySide6.__version__}\n",
+        f"Available Qt Themes: {', '.join(Qw.QStyleFactory.keys())}\n",
+        f"Current Qt Theme: {current_app_theme_name}\n",
+        f"Current Icon Theme: {icon_theme_name}\n",
+        f"Available Color Themes: {', '.join(map(lambda a: a[1], get_available_themes()))}\n",
+        f"System locale: {Qc.QLocale.system().name()}\n",
+        f"CPU Cores: {os.cpu_count()}\n",
+        f"Memory: {sys_virtual_memory_total() / 1024 ** 3:.2f} GiB\n",
+        f"Swap: {sys_swap_memory_total() / 1024 ** 3:.2f} GiB\n",
+    ]
+
+    return "".join(parts)
+
+
+@cache
 def get_config_path() -> Path:
     """
     Get the path to the configuration file for both Linux and Windows.
+    The path is resolved (and its parent created) once, then cached.
     """
     xdg_path = os.getenv("XDG_CONFIG_HOME") or Path.home() / ".config"
 
-    if platform.system() == "Linux":
+    if _SYSTEM == "Linux":
         path = Path(XDG_CONFIG_HOME, __program__, __program__ + "rc")
-    elif platform.system() == "Windows":
+    elif _SYSTEM == "Windows":
         path = Path(
             xdg_path if "XDG_CONFIG_HOME" in os.environ else os.getenv("APPDATA"),
             __program__,
             __program__ + "config.ini",
         )
-    elif platform.system() == "Darwin":
+    elif _SYSTEM == "Darwin":
         path = Path(
             (
                 xdg_path
@@ -122,21 +148,23 @@ def get_config_path() -> Path:
     return path
 
 
+@cache
 def get_cache_path() -> Path:
     """
     Get the default suggested path to the cache directory for both Linux and Windows.
+    The path is resolved (and created) once, then cached.
     """
     xdg_path = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
 
-    if platform.system() == "Linux":
+    if _SYSTEM == "Linux":
         path = Path(XDG_CACHE_HOME, __program__)
-    elif platform.system() == "Windows":
+    elif _SYSTEM == "Windows":
         path = Path(
             xdg_path if "XDG_CACHE_HOME" in os.environ else os.getenv("APPDATA"),
             __program__,
             "cache",
         )
-    elif platform.system() == "Darwin":
+    elif _SYSTEM == "Darwin":
         path = Path(
             xdg_path if "XDG_CACHE_HOME" in os.environ else (Path.home() / "Library" / "Caches"),
             __program__,
@@ -148,6 +176,7 @@ def get_cache_path() -> Path:
     return path
 
 
+@cache
 def get_log_path() -> Path:
     """
     Get the path to the log file.
@@ -156,6 +185,7 @@ def get_log_path() -> Path:
     return get_cache_path() / f"{__program__}.log"
 
 
+@cache
 def get_available_themes() -> list[tuple[str, str]]:
     """
     Check the data/color_themes directory for available themes.
@@ -165,6 +195,7 @@ def get_available_themes() -> list[tuple[str, str]]:
     with spaces instead of underscores.
 
     Note: The implicit system theme is not included in the list.
+    The themes are bundled with the program, so the result is cached. Don't mutate it.
 
     :return: A list of available theme names with their display names.
     """
@@ -172,47 +203,83 @@ def get_available_themes() -> list[tuple[str, str]]:
     themes = []
     with resources.path(handtex.data.color_themes, "") as theme_dir:
         theme_dir = Path(theme_dir)
-    for theme_file in theme_dir.iterdir():
-        # Skip dirs and empty files.
-        if theme_file.is_dir() or theme_file.stat().st_size == 0:
-            continue
-        theme_name = theme_file.stem
-        content = theme_file.read_text()
-        display_name = theme_name.replace("_", " ").capitalize()
-        in_general_section = False
-        for line in content.split("\n"):
-            line = line.strip()
-            if line.startswith("[General]"):
-                in_general_section = True
-            elif line.startswith("[") and line.endswith("]"):
-                if in_general_section:
-                    # We found general, but came across the next section now.
-                    break
-                in_general_section = False
-            elif "=" in line:
-                key, value = map(str.strip, line.split("=", 1))
-                if key == "Name":
-                    display_name = value
-                    break
-        themes.append((theme_name, display_name))
+    # Scandir entries cache the file type, saving a syscall per file.
+    with os.scandir(theme_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                continue
+            # Read each file exactly once, instead of a stat followed by a read.
+            with open(entry.path, "rb") as file:
+                raw_content = file.read()
+            # Skip empty files.
+            if not raw_content:
+                continue
+            theme_name = Path(entry.name).stem
+            display_name = theme_name.replace("_", " ").capitalize()
+            # Without a name key, there's nothing to look for.
+            if b"Name" not in raw_content:
+                themes.append((theme_name, display_name))
+                continue
+            content = raw_content.decode("utf-8")
+            # Jump straight to the general section, skipping all others.
+            general_section = _THEME_GENERAL_SECTION_RE.search(content)
+            if general_section is not None:
+                for match in _THEME_LINE_RE.finditer(content, general_section.end()):
+                    if match["section"] is not None:
+                        # We came across the next section, so there is no name.
+                        break
+                    if match["key"] == "Name":
+                        display_name = match["value"]
+                        break
+            themes.append((theme_name, display_name))
 
     return themes
 
 
-def closest_match(word: str, choices: list[str]) -> str | None:
+def closest_match(
+    word: str, choices: list[str] | tuple[str, ...], cutoff: float = 0.5
+) -> str | None:
     """
     Return the closest match for the given word in the list of choices.
     If no good match is found, return None.
+
+    This is equivalent to difflib.get_close_matches(word, choices, 1, cutoff),
+    but the matcher is reused across candidates and each ratio only computed once.
+    Fuzzy lookups are memoized, pass a tuple to skip copying the choices each call.
+
+    :param word: The word to look up.
+    :param choices: The candidates to match against.
+    :param cutoff: [Optional] Minimum similarity ratio to be considered a match.
+    :return: The best candidate, or None.
     """
     if word in choices:
         return word
-    else:
-        # Find the closest match using difflib:
-        closest = difflib.get_close_matches(word, choices, 1, 0.5)  # 0.6 is the default threshold
-        if closest:
-            return str(closest[0])
-        else:
-            return None
+    if not isinstance(choices, tuple):
+        choices = tuple(choices)
+    return _fuzzy_closest_match(word, choices, cutoff)
+
+
+@lru_cache(maxsize=4096)
+def _fuzzy_closest_match(word: str, choices: tuple[str, ...], cutoff: float) -> str | None:
+    # SequenceMatcher caches detailed information about the second sequence,
+    # so the word stays fixed while the candidates are swapped in as the first.
+    matcher = difflib.SequenceMatcher()
+    matcher.set_seq2(word)
+    best: tuple[float, str] | None = None
+    for choice in choices:
+        matcher.set_seq1(choice)
+        if matcher.real_quick_ratio() < cutoff or matcher.quick_ratio() < cutoff:
+            continue
+        ratio = matcher.ratio()
+        if ratio < cutoff:
+            continue
+        # Ties are resolved like get_close_matches does it, by comparing the strings.
+        if best is None or (ratio, choice) > best:
+            best = (ratio, choice)
+
+    if best is None:
+        return None
+    return str(best[1])
 
 
 def f_plural(value, singular: str, plural: str = "") -> str:
@@ -224,9 +291,7 @@ def f_plural(value, singular: str, plural: str = "") -> str:
     :param plural: (Optional) Plural form. If not given, the singular form is used with an 's' appended.
     :return: The appropriate form.
     """
-    if not plural:
-        plural = singular + "s"
-    return singular if value == 1 else plural
+    return singular if value == 1 else (plural or singular + "s")
 
 
 def f_time(seconds: int) -> str:
@@ -239,18 +304,15 @@ def f_time(seconds: int) -> str:
     """
     if seconds < 60:
         return f"{seconds} {f_plural(seconds, 'second')}"
-    elif seconds < 60 * 60:
-        minutes = seconds // 60
-        seconds = seconds % 60
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
         return f"{minutes} {f_plural(minutes, 'minute')} {seconds} {f_plural(seconds, 'second')}"
-    else:
-        hours = seconds // (60 * 60)
-        minutes = (seconds % (60 * 60)) // 60
-        return (
-            f"{hours} {f_plural(hours, 'hour')} "
-            f"{minutes} {f_plural(minutes, 'minute')}"
-            f"   [You're batshit insane!]"
-        )
+    hours, minutes = divmod(minutes, 60)
+    return (
+        f"{hours} {f_plural(hours, 'hour')} "
+        f"{minutes} {f_plural(minutes, 'minute')}"
+        f"   [You're batshit insane!]"
+    )
 
 
 def open_file(path: Path) -> None:
@@ -258,11 +320,20 @@ def open_file(path: Path) -> None:
     Open any given file with the default application.
     """
     logger.info(f"Opening file {path}")
-    try:
-        # Use Qt to open the file, so that it works on all platforms.
-        Qg.QDesktopServices.openUrl(Qc.QUrl.fromLocalFile(str(path)))
-    except Exception as e:
-        logger.exception(e)
+    # Use Qt to open the file, so that it works on all platforms.
+    # Qt reports failure through the return value, it doesn't raise.
+    if not Qg.QDesktopServices.openUrl(Qc.QUrl.fromLocalFile(os.fspath(path))):
+        logger.error(f"Failed to open file {path}")
+
+
+def numbered_file_paths(file_path: Path) -> Iterator[Path]:
+    """
+    Yield the given file path, followed by numbered variants of it,
+    e.g. file.txt, file_1.txt, file_2.txt, ...
+    """
+    yield file_path
+    for counter in itertools.count(1):
+        yield file_path.parent / (file_path.stem + "_" + str(counter) + file_path.suffix)
 
 
 def ensure_unique_file_path(file_path: Path) -> Path:
@@ -270,26 +341,35 @@ def ensure_unique_file_path(file_path: Path) -> Path:
     Ensure that the file path is unique.
     If the file already exists, append a number to the file name,
     incrementing it until a unique file path is found.
+    Note: The path is not reserved, use backup_file if the file should be created atomically.
     """
-    counter = 1
-    output_file_path = file_path
-    while output_file_path.exists():
-        output_file_path = file_path.parent / (
-            file_path.stem + "_" + str(counter) + file_path.suffix
-        )
-        counter += 1
-    return output_file_path
+    for output_file_path in numbered_file_paths(file_path):
+        if not output_file_path.exists():
+            return output_file_path
 
 
 def backup_file(path: Path, extension: str = ".backup") -> Path:
     """
     Create a backup of the file by copying it to the same location with the given extension.
+    If a backup already exists, a number is appended to the backup's name.
     """
-    backup_path = path.with_suffix(path.suffix + extension)
-    backup_path = ensure_unique_file_path(backup_path)
-    logger.info(f"Backing up file {path} to {backup_path}")
-    shutil.copy(path, backup_path)
-    return backup_path
+    # Open the source first, so that a missing or unreadable file leaves no empty backup behind.
+    with open(path, "rb") as source:
+        for backup_path in numbered_file_paths(path.with_suffix(path.suffix + extension)):
+            # Creating the file exclusively checks for existence and claims the path in one go.
+            try:
+                fd = os.open(backup_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                continue
+            try:
+                with os.fdopen(fd, "wb") as destination:
+                    shutil.copyfileobj(source, destination)
+                shutil.copymode(path, backup_path)
+            except BaseException:
+                backup_path.unlink(missing_ok=True)
+                raise
+            logger.info(f"Backed up file {path} to {backup_path}")
+            return backup_path
 
 
 class RecoverableParseException(Exception):
@@ -312,6 +392,44 @@ class CriticalParseError(Exception):
     pass
 
 
+@lru_cache(maxsize=None)
+def _resolve_type_hints(cls: type, include_until_base: tuple[type, ...]) -> dict[str, type]:
+    """
+    Gather the type hints for the attributes of the given class, see load_dict_to_attrs_safely.
+    Resolving type hints is slow, so this is cached per class. Don't mutate the result.
+
+    :param cls: The class to gather the type hints for.
+    :param include_until_base: Include attributes of base classes until these classes.
+    :return: A mapping of attribute names to their types.
+    """
+    # Only the annotations an instance of the class would see, meaning those of the nearest
+    # class in the MRO that defines any. Base classes must be included explicitly.
+    own_annotations = next(
+        (
+            klass.__dict__["__annotations__"]
+            for klass in cls.__mro__
+            if "__annotations__" in klass.__dict__
+        ),
+        {},
+    )
+    all_type_hints = get_type_hints(cls)
+    type_info = {attribute: all_type_hints[attribute] for attribute in own_annotations}
+    # Gather type hints from base classes if requested.
+    # Walk the linearized MRO, skipping anything past the requested bases.
+    if include_until_base:
+        bases = cls.__mro__[1:]
+        beyond_bases = {
+            ancestor
+            for base in bases
+            if base in include_until_base
+            for ancestor in base.__mro__[1:]
+        }
+        for base_class in bases:
+            if base_class not in beyond_bases:
+                type_info.update(get_type_hints(base_class))
+    return type_info
+
+
 def load_dict_to_attrs_safely(
     dataclass: object,
     data: dict,
@@ -335,17 +453,11 @@ def load_dict_to_attrs_safely(
     :return: A list of exceptions that occurred during loading.
     """
     recoverable_exceptions: list[RecoverableParseException] = []
-    type_info = get_type_hints(dataclass)
-    # Gather type hints from base classes if requested.
-    if include_until_base:
-        if not isinstance(include_until_base, list):
-            include_until_base = [include_until_base]
-        base_classes = list(type(dataclass).__bases__)
-        while base_classes:
-            base_class = base_classes.pop(0)
-            type_info.update(get_type_hints(base_class))
-            if base_class not in include_until_base:
-                base_classes.extend(list(base_class.__bases__))
+    if include_until_base is None:
+        include_until_base = ()
+    elif not isinstance(include_until_base, list):
+        include_until_base = (include_until_base,)
+    type_info = _resolve_type_hints(type(dataclass), tuple(include_until_base))
 
     for attribute in type_info:
         if skip_attrs and attribute in skip_attrs:
@@ -356,6 +468,11 @@ def load_dict_to_attrs_safely(
             value = data[attribute]
             expected_type = type_info[attribute]
             try:
+                # Values that already have the right type needn't be converted again.
+                # Compare exactly, so that e.g. bools still get cast for int attributes.
+                if type(value) is (get_origin(expected_type) or expected_type):
+                    setattr(dataclass, attribute, value)
+                    continue
                 setattr(dataclass, attribute, expected_type(value))
             except Exception as e:
                 logger.exception(f"Failed to cast attribute {attribute} to the correct type.")
@@ -433,9 +550,11 @@ def load_symbol_svg(symbol: st.Symbol, fill_color: str = "#000000") -> Qc.QByteA
     return Qc.QByteArray(svg_data.encode("utf-8"))
 
 
+@cache
 def sys_virtual_memory_total() -> int:
     """
     Get the total amount of RAM in the system in bytes.
+    This can't change at runtime, so it is cached.
     """
     try:
         return psutil.virtual_memory().total
@@ -1,8 +1,19 @@
 import sqlite3
 from pathlib import Path
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
 
 
-from training.data_loader import get_data_split, DataSplit, StrokeDataset
+import handtex.detector.image_gen as ig
+from training.data_loader import (
+    get_data_split,
+    DataSplit,
+    StrokeDataset,
+    build_stroke_cache,
+    create_dataloader,
+    migrate_stroke_blobs,
+)
 
 split_percentages = {
     DataSplit.TRAIN: 50,
@@ -107,10 +118,14 @@ def create_test_db(db_path: Path):
     cur = conn.cursor()
     cur.execute("CREATE TABLE samples (id INTEGER PRIMARY KEY, key TEXT, strokes TEXT)")
     # Insert samples for key "A"
-    cur.executemany("INSERT INTO samples VALUES (?, ?, ?)", [(i, "A", "") for i in range(1, 21)])
+    cur.executemany(
+        "INSERT INTO samples VALUES (?, ?, ?)",
+        [(i, "A", "[[[0, 0], [1000, 1000]]]") for i in range(1, 21)],
+    )
     # Insert at least 3 samples for key "latex2e-|"
     cur.executemany(
-        "INSERT INTO samples VALUES (?, ?, ?)", [(i + 100, "latex2e-|", "") for i in range(1, 4)]
+        "INSERT INTO samples VALUES (?, ?, ?)",
+        [(i + 100, "latex2e-|", "[[[500, 0], [500, 1000]]]") for i in range(1, 4)],
     )
     conn.commit()
     conn.close()
@@ -172,5 +187,60 @@ def test_bootstrapping_determinism(tmp_path):
         random_augmentation=False,
     )
 
-    # For our purposes, we check that the primary keys (after bootstrapping and splitting) are identical.
-    assert ds1.primary_keys == ds2.primary_keys
+    # For our purposes, we check that the samples (after bootstrapping and splitting) are identical.
+    np.testing.assert_array_equal(ds1.primary_keys, ds2.primary_keys)
+    np.testing.assert_array_equal(ds1.symmetry_indices, ds2.symmetry_indices)
+    np.testing.assert_array_equal(ds1.composition_indices, ds2.composition_indices)
+    np.testing.assert_array_equal(ds1.composite_ids, ds2.composite_ids)
+    np.testing.assert_array_equal(ds1.augmentation_seeds, ds2.augmentation_seeds)
+    assert ds1.range_for_symbol("A") == range(len(ds1))
+
+
+def test_stroke_blob_migration(tmp_path):
+    db_file = tmp_path / "test.db"
+    create_test_db(db_file)
+
+    stroke_cache = build_stroke_cache(str(db_file))
+    assert ig.unpack_strokes(*stroke_cache[1]) == [[[0, 0], [1000, 1000]]]
+    assert ig.unpack_strokes(*stroke_cache[101]) == [[[500, 0], [500, 1000]]]
+    assert stroke_cache.missing([1, 101, 999]) == [999]
+
+    # Running the migration again must leave the already converted rows alone.
+    migrate_stroke_blobs(str(db_file))
+    assert ig.unpack_strokes(*build_stroke_cache(str(db_file))[1]) == [[[0, 0], [1000, 1000]]]
+
+
+def test_chunked_dataloader_batches():
+    dataset = TensorDataset(torch.arange(103))
+    dataloader = create_dataloader(dataset, batch_size=10, shuffle=True, num_workers=2)
+
+    batches = [batch for batch, in dataloader]
+    assert len(batches) == len(dataloader)
+    assert [len(batch) for batch in batches] == [10] * 10 + [3]
+    assert sorted(torch.cat(batches).tolist()) == list(range(103))
+
+
+def test_image_cache(tmp_path):
+    db_file = tmp_path / "test.db"
+    create_test_db(db_file)
+
+    def make_dataset(image_cache_dir):
+        return StrokeDataset(
+            db_path=str(db_file),
+            symbol_data=DummySymbolData(),
+            image_size=28,
+            label_encoder=DummyLabelEncoder(),
+            random_seed=42,
+            split=DataSplit.TRAIN,
+            split_percentages=split_percentages,
+            random_augmentation=False,
+            image_cache_dir=image_cache_dir,
+        )
+
+    uncached = make_dataset(None)
+    # The first dataset fills the cache, the second reads it back.
+    for _ in range(2):
+        cached = make_dataset(str(tmp_path / "images"))
+        for idx in range(len(uncached)):
+            assert torch.equal(cached[idx][0], uncached[idx][0])
+    assert cached.image_cache[1].all()
@@ -0,0 +1,55 @@
+import random
+
+import numpy as np
+import torch
+
+import handtex.detector.image_gen as ig
+import training.image_gen_numba as ign
+import training.image_gen_torch as igt
+
+
+def test_numba_rasterizer_matches_pillow():
+    # Training and inference must see identical images, including clipped and single points.
+    rng = random.Random(0)
+    for _ in range(500):
+        strokes = [
+            [(rng.randint(-100, 1100), rng.randint(-100, 1100)) for _ in range(rng.randint(1, 6))]
+            for _ in range(rng.randint(1, 4))
+        ]
+        image_size = rng.choice([28, 64])
+        points, offsets = ig.pack_strokes(strokes)
+
+        expected = ig.strokes_to_grayscale_image(strokes, image_size)
+        actual = ign.points_to_grayscale_image(points, offsets, image_size)
+        assert np.array_equal(expected, actual)
+
+
+def test_torch_rasterizer_matches_pillow():
+    rng = random.Random(1)
+    for _ in range(50):
+        batch = []
+        for _ in range(rng.randint(1, 8)):
+            strokes = [
+                [
+                    (rng.randint(-100, 1100), rng.randint(-100, 1100))
+                    for _ in range(rng.randint(1, 6))
+                ]
+                for _ in range(rng.randint(1, 4))
+            ]
+            # Repeated points must still be detected as single points.
+            strokes.append([strokes[0][0]] * rng.randint(1, 3))
+            batch.append(strokes)
+        image_size = rng.choice([28, 64])
+
+        points = torch.tensor(
+            [point for strokes in batch for stroke in strokes for point in stroke]
+        )
+        stroke_starts = torch.tensor(
+            [i == 0 for strokes in batch for stroke in strokes for i in range(len(stroke))]
+        )
+        point_counts = torch.tensor([sum(map(len, strokes)) for strokes in batch])
+
+        images = igt.rasterize_strokes(points, stroke_starts, point_counts, image_size)
+        for strokes, image in zip(batch, images):
+            expected = ig.strokes_to_grayscale_image(strokes, image_size)
+            assert np.array_equal(expected, image[0].numpy())
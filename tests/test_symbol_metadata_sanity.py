@@ -1,4 +1,5 @@
 import re
+from collections import Counter
 from time import time
 from importlib import resources
 from pathlib import Path
@@ -14,6 +15,10 @@ from handtex.data import symbol_metadata
 import handtex.structures as st
 
 
+# A key is a string of 1 or more characters, no whitespace.
+_KEY_RE = re.compile(r"\S+")
+
+
 def test_similar_lists_disjunct() -> None:
     """
     Test that the symbol lists are disjunct.
@@ -21,15 +26,15 @@ def test_similar_lists_disjunct() -> None:
     with resources.path(symbol_metadata, "") as metadata_dir:
         metadata_dir = Path(metadata_dir)
     files = list(metadata_dir.glob("similar*"))
+    file_contents = {file: file.read_text() for file in files}
 
     # Check that each file is consistent on it's own.
     for file in files:
-        line_symbols: list[set[str]]
-        line_symbols = []
+        # Since all lines must be disjunct, none can be a subset of another either,
+        # so a single running union is enough to check both.
+        union_so_far: set[str] = set()
 
-        with file.open("r") as f:
-            lines = f.readlines()
-        for line in lines:
+        for line in file_contents[file].splitlines():
             symbols = line.strip().split()
             line_symbol_set = set()
             for s in symbols:
@@ -37,33 +42,20 @@ def test_similar_lists_disjunct() -> None:
                     s not in line_symbol_set
                 ), f"Symbol {s} is listed twice in {file}, line {line}"
                 line_symbol_set.add(s)
-            assert line_symbol_set not in line_symbols, f"Line {line} is listed twice in {file}"
-            line_symbols.append(line_symbol_set)
-
-        # Check that no two lines are a subset of each other.
-        for i, line1 in enumerate(line_symbols, 1):
-            for j, line2 in enumerate(line_symbols, 1):
-                if i == j:
-                    continue
-                assert not line1.issubset(line2), f"Line {i} is a subset of line {j} in {file}"
-
-        # Check that all lines are disjunct.
-        for i, line1 in enumerate(line_symbols, 1):
-            for j, line2 in enumerate(line_symbols, 1):
-                if i == j:
-                    continue
-                assert not line1 & line2, f"Line {i} and line {j} share symbols in {file}"
+            assert line_symbol_set, f"Empty line in {file}"
+            assert line_symbol_set.isdisjoint(
+                union_so_far
+            ), f"Line {line} shares symbols with a previous line in {file}"
+            union_so_far |= line_symbol_set
 
     # There cannot be the same key listed twice in the file.
     global_keys = set()
     for file in files:
         # Just parse out all the keys with a regex.
-        # A key is a string of 1 or more characters, no whitespace.
-        keys = list(re.findall(r"\S+", file.read_text()))
+        keys = _KEY_RE.findall(file_contents[file])
         key_set = set(keys)
-        for key in key_set:
-            keys.remove(key)
-        assert not keys, f"File {file} contains duplicate keys: {keys}"
+        duplicates = [key for key, count in Counter(keys).items() if count > 1]
+        assert not duplicates, f"File {file} contains duplicate keys: {duplicates}"
 
         # The keys in this file must not be in the global set.
         intersection = global_keys & key_set
@@ -52,10 +52,10 @@ def main():
         for drawing in data:
             key = drawing["key"]
             strokes = drawing["strokes"]
-            cursor.execute("SELECT * FROM samples WHERE key=?", (key,))
+            cursor.execute("SELECT strokes FROM samples WHERE key=?", (key,))
             db_data = cursor.fetchall()
             for db_drawing in db_data:
-                db_strokes = json.loads(db_drawing[2])
+                db_strokes = json.loads(db_drawing[0])
                 if matching_strokes(db_strokes, strokes):
                     drawings_match.append(drawing)
                     break
@@ -14,6 +14,8 @@ def main():
         key TEXT,
         strokes TEXT
     )
+    The packed pts_blob and offs_blob columns are filled in by
+    data_loader.migrate_stroke_blobs the next time the dataset is loaded.
     """
 
     conn = sqlite3.connect(db_path)
@@ -8,7 +8,9 @@ cursor.execute(
     CREATE TABLE samples (
         id INTEGER PRIMARY KEY,
         key TEXT,
-        strokes TEXT
+        strokes TEXT,
+        pts_blob BLOB,
+        offs_blob BLOB
     )
 """
 )
@@ -1,17 +1,28 @@
 import csv
+import hashlib
 import json
+import queue
 import random
 import sqlite3
+import threading
+from collections import defaultdict
 from enum import Enum
-from functools import cache
 from itertools import cycle
-from math import floor
+from math import ceil, floor
+from pathlib import Path
+from typing import Callable, Iterable
 
 import numpy as np
 import torch
-import torchvision.transforms as transforms
 from sklearn.preprocessing import LabelEncoder
-from torch.utils.data import Dataset
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    Sampler,
+    SequentialSampler,
+)
 from PIL import Image
 
 import handtex.data.symbol_metadata
@@ -21,8 +32,12 @@ import handtex.utils as ut
 import training.database
 import handtex.detector.image_gen as ig
 import training.shape_classifier as sc
+import training.image_gen_numba as ign
 import handtex.sketchpad as sp
 
+# Part of the image cache's file name, bump it whenever the rendering of the images changes.
+IMAGE_CACHE_VERSION = 1
+
 
 class DataSplit(Enum):
     TRAIN = 0
@@ -30,17 +45,120 @@ class DataSplit(Enum):
     TEST = 2
 
 
-def build_stroke_cache(db_path: str) -> dict[str, list[list[tuple[int, int]]]]:
+def migrate_stroke_blobs(db_path: str) -> None:
     """
-    Build a cache of the stroke data for each symbol in the database.
-    This maps the id to the strokes, the key information is lost.
+    Store a pre-parsed copy of the stroke data next to the JSON, so that loading a sample
+    is a plain memory copy instead of JSON decoding.
+    This adds the pts_blob (int16 x, y pairs) and offs_blob (int32 stroke boundaries) columns
+    if needed, and fills them in for every row that doesn't have them yet, so it is cheap
+    to call again after new drawings were ingested.
     """
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT id, strokes FROM samples")
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(samples)")}
+    for column in ("pts_blob", "offs_blob"):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE samples ADD COLUMN {column} BLOB")
+
+    cursor.execute("SELECT id, strokes FROM samples WHERE pts_blob IS NULL")
     rows = cursor.fetchall()
-    stroke_cache = {key: json.loads(strokes) for key, strokes in rows}
+    if rows:
+        blobs = []
+        for primary_key, strokes in rows:
+            points, offsets = ig.pack_strokes(json.loads(strokes))
+            blobs.append((points.tobytes(), offsets.tobytes(), primary_key))
+        cursor.executemany("UPDATE samples SET pts_blob = ?, offs_blob = ? WHERE id = ?", blobs)
+        conn.commit()
+
+    conn.close()
+
+
+class StrokeCache:
+    """
+    The packed stroke data of many samples, see ig.pack_strokes, kept in a few flat arrays.
+    A dict of small arrays would be millions of Python objects, and dataloader workers copy
+    every page on which they touch a reference count. Flat arrays stay shared with the
+    parent process instead.
+    """
+
+    def __init__(self):
+        self.points = np.empty((0, 2), dtype=np.int16)
+        self.offsets = np.empty(0, dtype=np.int32)
+        # Sample i has the points point_starts[i] : point_starts[i + 1], likewise for offsets.
+        self.point_starts = np.zeros(1, dtype=np.int64)
+        self.offset_starts = np.zeros(1, dtype=np.int64)
+        # Maps the primary key to the sample index, -1 for samples that aren't cached.
+        self.index_by_id = np.empty(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.point_starts) - 1
+
+    def __contains__(self, primary_key: int) -> bool:
+        return 0 <= primary_key < len(self.index_by_id) and self.index_by_id[primary_key] >= 0
+
+    def __getitem__(self, primary_key: int) -> tuple[np.ndarray, np.ndarray]:
+        if primary_key not in self:
+            raise KeyError(primary_key)
+        index = self.index_by_id[primary_key]
+        return (
+            self.points[self.point_starts[index] : self.point_starts[index + 1]],
+            self.offsets[self.offset_starts[index] : self.offset_starts[index + 1]],
+        )
+
+    def missing(self, primary_keys: Iterable[int]) -> list[int]:
+        """
+        Get the given primary keys that aren't cached, in ascending order.
+        """
+        primary_keys = np.unique(np.fromiter(primary_keys, dtype=np.int64))
+        cached = primary_keys < len(self.index_by_id)
+        cached[cached] = self.index_by_id[primary_keys[cached]] >= 0
+        return primary_keys[~cached].tolist()
+
+    def add(self, rows: list[tuple[int, bytes, bytes]]) -> None:
+        """
+        Add samples to the cache.
+
+        :param rows: The id, pts_blob and offs_blob of each sample, see migrate_stroke_blobs.
+        """
+        if not rows:
+            return
+        ids = np.array([primary_key for primary_key, _, _ in rows], dtype=np.int64)
+        # Both points (2 x int16) and offsets (int32) take 4 bytes per entry.
+        point_counts = np.array([len(points) // 4 for _, points, _ in rows], dtype=np.int64)
+        offset_counts = np.array([len(offsets) // 4 for _, _, offsets in rows], dtype=np.int64)
+        points = np.frombuffer(b"".join(points for _, points, _ in rows), dtype=np.int16)
+        offsets = np.frombuffer(b"".join(offsets for _, _, offsets in rows), dtype=np.int32)
+
+        first_index = len(self)
+        self.points = np.concatenate((self.points, points.reshape(-1, 2)))
+        self.offsets = np.concatenate((self.offsets, offsets))
+        self.point_starts = np.concatenate(
+            (self.point_starts, self.point_starts[-1] + np.cumsum(point_counts))
+        )
+        self.offset_starts = np.concatenate(
+            (self.offset_starts, self.offset_starts[-1] + np.cumsum(offset_counts))
+        )
+        if ids.max() >= len(self.index_by_id):
+            index_by_id = np.full(ids.max() + 1, -1, dtype=np.int64)
+            index_by_id[: len(self.index_by_id)] = self.index_by_id
+            self.index_by_id = index_by_id
+        self.index_by_id[ids] = np.arange(first_index, first_index + len(ids))
+
+
+def build_stroke_cache(db_path: str) -> StrokeCache:
+    """
+    Build a cache of the packed stroke data for each symbol in the database.
+    This maps the id to the strokes, the key information is lost.
+    """
+    migrate_stroke_blobs(db_path)
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT id, pts_blob, offs_blob FROM samples")
+    stroke_cache = StrokeCache()
+    stroke_cache.add(cursor.fetchall())
 
     conn.close()
     return stroke_cache
@@ -119,6 +237,232 @@ def get_data_split(
     return data[start_idx:end_idx]
 
 
+class ChunkedBatchSampler(Sampler[list[int]]):
+    """
+    Split every batch of the given batch sampler into smaller chunks.
+    The DataLoader hands each chunk to the next worker in turn, so a batch is spread over
+    all workers instead of one worker having to produce it alone. That way a few costly
+    samples (compositions, perlin noise) in one batch don't hold up the whole pipeline.
+    """
+
+    def __init__(self, batch_sampler: BatchSampler, chunks: int):
+        self.batch_sampler = batch_sampler
+        self.chunks = chunks
+
+    def __iter__(self):
+        for batch in self.batch_sampler:
+            chunk_size = self.chunk_size(len(batch))
+            for start in range(0, len(batch), chunk_size):
+                yield batch[start : start + chunk_size]
+
+    def __len__(self) -> int:
+        # All batches are full, except maybe the last one.
+        batch_size = self.batch_sampler.batch_size
+        full_batches, remainder = divmod(len(self.batch_sampler.sampler), batch_size)
+        chunk_count = full_batches * ceil(batch_size / self.chunk_size(batch_size))
+        if remainder:
+            chunk_count += ceil(remainder / self.chunk_size(remainder))
+        return chunk_count
+
+    def chunk_size(self, batch_length: int) -> int:
+        return ceil(batch_length / self.chunks)
+
+
+class ChunkedDataLoader:
+    """
+    Iterate over batches that the workers produce in chunks, see ChunkedBatchSampler.
+    The chunks are joined back into complete batches in the main process.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        batch_size: int,
+        shuffle: bool,
+        num_workers: int,
+        collate_fn: Callable | None = None,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        self.batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+        chunks = max(num_workers, 1)
+        self.pin_memory = torch.cuda.is_available()
+        self.loader = DataLoader(
+            dataset,
+            batch_sampler=ChunkedBatchSampler(self.batch_sampler, chunks),
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+            # Keep as many samples in flight as whole batches would.
+            prefetch_factor=2 * chunks if num_workers > 0 else None,
+            persistent_workers=num_workers > 0,
+        )
+
+    def __len__(self) -> int:
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        if not self.pin_memory:
+            yield from self.joined_batches()
+            return
+        # Join and pin the batches in a background thread, like the DataLoader's own
+        # pin_memory thread, so that the copy into pinned memory overlaps with training.
+        batches = queue.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.joined_batches():
+                    if not put(batch):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while (batch := batches.get()) is not None:
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def joined_batches(self):
+        pending = []
+        pending_size = 0
+        for chunk in self.loader:
+            pending.append(chunk)
+            # The labels come last, with one entry per sample.
+            pending_size += len(chunk[-1])
+            # Only the last batch can come up short.
+            if pending_size == self.batch_size:
+                yield self.join_chunks(pending)
+                pending = []
+                pending_size = 0
+        if pending:
+            yield self.join_chunks(pending)
+
+    def join_chunks(self, chunks: list[list[torch.Tensor]]) -> list[torch.Tensor]:
+        if len(chunks) == 1:
+            if self.pin_memory:
+                return [tensor.pin_memory() for tensor in chunks[0]]
+            return chunks[0]
+        if not self.pin_memory:
+            return [torch.cat(parts) for parts in zip(*chunks)]
+        # Concatenate straight into pinned memory, instead of copying the joined batch again.
+        batch = []
+        for parts in zip(*chunks):
+            shape = (sum(len(part) for part in parts), *parts[0].shape[1:])
+            pinned = torch.empty(shape, dtype=parts[0].dtype, pin_memory=True)
+            batch.append(torch.cat(parts, out=pinned))
+        return batch
+
+
+def create_dataloader(
+    dataset: Dataset,
+    batch_size: int,
+    shuffle: bool,
+    num_workers: int = 4,
+    collate_fn: Callable | None = None,
+) -> ChunkedDataLoader:
+    """
+    Create a DataLoader for a StrokeDataset.
+    Each batch is split among all workers, see ChunkedBatchSampler.
+    The workers are kept alive between epochs instead of being forked anew each time,
+    and batches land in pinned memory when training on the GPU, so that moving them
+    with .to(device, non_blocking=True) overlaps with the computation.
+
+    :param dataset: The dataset to load from.
+    :param batch_size: Number of samples per batch.
+    :param shuffle: Whether to reshuffle the samples every epoch.
+    :param num_workers: Number of worker processes.
+    :param collate_fn: [Optional] How to batch the samples, e.g. collate_strokes.
+        The batch must be a sequence of tensors that can be concatenated, labels last.
+    :return: The DataLoader.
+    """
+    return ChunkedDataLoader(dataset, batch_size, shuffle, num_workers, collate_fn)
+
+
+def normalize_images(images: torch.Tensor) -> torch.Tensor:
+    """
+    Convert a batch of uint8 images from the StrokeDataset to floats in the range [-1, 1],
+    the same as ToTensor and Normalize((0.5,), (0.5,)) do for inference.
+    Do this after moving the batch to the device.
+
+    :param images: The uint8 images.
+    :return: The normalized float images.
+    """
+    return images.float().mul_(1 / 127.5).sub_(1)
+
+
+def symmetry_matrix(transformations: tuple[st.Transformation, ...]) -> np.ndarray:
+    """
+    Combine the rotations and reflections of a symmetry into a single matrix.
+    """
+    trans_mats = []
+    for transformation in transformations:
+        if transformation.is_rotation:
+            trans_mats.append(ig.rotation_matrix(transformation.angle))
+        else:
+            trans_mats.append(ig.reflection_matrix(transformation.angle))
+    return ig.combine_transformations(trans_mats)
+
+
+def negation_matrix(negation: st.Negation) -> np.ndarray:
+    """
+    Build the matrix that places the vertical line on top of the symbol to negate it.
+    """
+    # Use -y_offset, since the negation views up as positive y, but in the image it's
+    # in the negative y direction.
+    return ig.combine_transformations(
+        [
+            ig.scale_matrix(negation.scale_factor, negation.scale_factor),
+            ig.rotation_matrix(negation.vert_angle),
+            ig.translation_matrix(negation.x_offset, -negation.y_offset, 1000),
+        ]
+    )
+
+
+def inside_matrix(inside: st.Inside, outer_stroke_data: list[list[tuple[int, int]]]) -> np.ndarray:
+    """
+    Build the matrix that shrinks the symbol to fit inside the given outer shape.
+    """
+    # Find out how large we need to scale the outer symbol to fit the inner symbol.
+    center_x, center_y = 500, 500
+    square_side_length = 1000
+    if inside == st.Inside.Circle:
+        _, square_side_length = sc.is_good_circle(outer_stroke_data)
+    elif inside == st.Inside.Square:
+        _, square_side_length = sc.is_good_square(outer_stroke_data)
+    elif inside == st.Inside.Triangle:
+        _, square_side_length, center_x, center_y = sc.is_good_triangle(outer_stroke_data)
+    else:
+        raise ValueError(f"Unknown inside relation: {inside}")
+
+    scale = square_side_length / 1000
+    scale *= 0.9  # Add a 10% margin to fit.
+
+    return ig.combine_transformations(
+        [
+            ig.scale_matrix(scale, scale),
+            ig.translation_matrix((center_x - 500) / 1000, (center_y - 500) / 1000, 1000),
+        ]
+    )
+
+
 class StrokeDataset(Dataset):
     def __init__(
         self,
@@ -131,17 +475,20 @@ class StrokeDataset(Dataset):
         split: DataSplit = DataSplit.TRAIN,
         class_limit: int | None = None,
         random_augmentation: bool = True,
-        stroke_cache: dict[str, list[list[tuple[int, int]]]] = None,
+        stroke_cache: StrokeCache | None = None,
         debug_single_sample_only: bool = False,
         distribution_stats: dict[str, tuple[int, int, int, int, int, int]] | None = None,
+        image_cache_dir: str | Path | None = None,
     ):
         """
-        The primary keys list consists of tuples containing the following:
-        - int: The primary key of the sample in the database.
-        - list[Transformation]: List of transformations to apply to the strokes before using it.
-          These are a result of using symmetries to augment the data.
-        - tuple[Negation | Inside | None, int]: An optional negation and the id of the slash / shape to apply to the symbol.
-        - int | None: If not None, this is the seed to use for random augmentation.
+        The samples are stored as parallel arrays, one entry per sample:
+        - primary_keys: The primary key of the sample in the database.
+        - symmetry_indices: Index into symmetry_matrices of the transformations to apply to the
+          strokes before using it, or -1. These are a result of using symmetries to augment the data.
+        - composition_indices: Index into compositions of the negation or inside relation
+          to apply to the symbol, or -1.
+        - composite_ids: The id of the slash / shape to apply to the symbol, if any.
+        - augmentation_seeds: If not -1, this is the seed to use for random augmentation.
           It is imperative that this be stored, so that the training and validation datasets
           generate the same pool of data and thus can be split consistently.
 
@@ -153,13 +500,17 @@ class StrokeDataset(Dataset):
         :param random_seed: Seed for the random number generator. Generator for training and validation MUST get the same.
         :param split: DataSplit enum to determine which split to use.
         :param random_augmentation: If True, augment the data with random transformations.
-        :param stroke_cache: Cache of stroke data for each symbol key, alternative to loading from database.
+        :param stroke_cache: Cache of stroke data from build_stroke_cache, alternative to loading from database.
         :param debug_single_sample_only: If True, only load a single sample for debugging.
         :param distribution_stats: If not none, it is populated with the statistics of the dataset.
+        :param image_cache_dir: If not None, the images of samples without random augmentation
+            are cached on disk in this directory, see cached_image. The directory holds a
+            single cache: when a new one is created, the files of any other cache in it are
+            deleted. Give every dataset that is used at the same time a directory of its own.
         """
         self.db_path = db_path
         self.image_size = image_size
-        self.primary_keys: list[
+        all_samples: list[
             tuple[
                 int,
                 tuple[st.Transformation, ...],
@@ -167,81 +518,107 @@ class StrokeDataset(Dataset):
                 int | None,
             ]
         ] = []
-        self.symbol_keys = []
+        # The samples of each symbol form a contiguous run.
+        self.symbol_ranges: dict[str, range] = {}
         self.split = split
-        self.stroke_cache = stroke_cache
+        # Without a shared cache, only the samples this dataset needs are loaded into a private one.
+        self.stroke_cache = stroke_cache if stroke_cache is not None else StrokeCache()
 
         # Store the seed and create an instance-level RNG so that bootstrapping is isolated.
         self.random_seed = random_seed
-        self.rng = random.Random(random_seed)
+        self.rng = np.random.default_rng(random_seed)
+
+        if stroke_cache is None:
+            migrate_stroke_blobs(self.db_path)
 
-        # Load primary keys and symbol keys from the database for the provided symbol keys
+        # Load the ids of all samples in one go, grouped by their symbol key.
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        cursor.execute("SELECT key, id FROM samples ORDER BY id")
+        ids_by_key: defaultdict[str, list[int]] = defaultdict(list)
+        for key, primary_key in cursor.fetchall():
+            ids_by_key[key].append(primary_key)
+        conn.close()
+
+        # The shuffled and split ids per group of symbol keys, which are asked for repeatedly.
+        split_ids: dict[tuple[tuple[str, ...], bool], list[int]] = {}
 
-        @cache
         def load_primary_keys(
             _symbol_keys: str | tuple[str] | list[str],
             *,
             ignore_single_debug_sample_limit: bool = False,
         ) -> list[int]:
-            nonlocal cursor, debug_single_sample_only
-
             if isinstance(_symbol_keys, str):
                 _symbol_keys = (_symbol_keys,)
-            command = f"SELECT id FROM samples WHERE key IN ({','.join(['?']*len(_symbol_keys))})"
-            if debug_single_sample_only and not ignore_single_debug_sample_limit:
-                command += " LIMIT 1"
-            cursor.execute(
-                command,
-                _symbol_keys,
+            _symbol_keys = tuple(_symbol_keys)
+            limit_to_single_sample = (
+                debug_single_sample_only and not ignore_single_debug_sample_limit
             )
-            # Unwrap the tuples, since squealite returns each row as such, even when selecting a single column.
-            cursor_samples = [row[0] for row in cursor.fetchall()]
+            memo_key = (_symbol_keys, limit_to_single_sample)
+            if memo_key in split_ids:
+                return split_ids[memo_key]
+
+            # Keep the order of the key index, sorted by key and then by id.
+            sample_ids = [
+                primary_key
+                for key in sorted(set(_symbol_keys))
+                for primary_key in ids_by_key.get(key, ())
+            ]
+            if limit_to_single_sample:
+                sample_ids = sample_ids[:1]
 
             # If there is only one sample, no shuffling is possible.
-            if len(cursor_samples) == 1:
-                return cursor_samples
-
-            # Bootstrapping: shuffle deterministically.
-            # Derive a seed from the global random_seed and the _symbol_keys
-            # (this ensures that the same symbol group always shuffles identically)
-            seed_for_shuffle = hash((self.random_seed, tuple(_symbol_keys)))
-            local_rng = random.Random(seed_for_shuffle)
-            local_rng.shuffle(cursor_samples)
-
-            nonlocal split
-            return get_data_split(cursor_samples, split, split_percentages)
+            if len(sample_ids) > 1:
+                # Bootstrapping: shuffle deterministically.
+                # Derive a seed from the global random_seed and the _symbol_keys
+                # (this ensures that the same symbol group always shuffles identically)
+                # Python's hash() of strings changes with every run, so use a stable digest.
+                seed_for_shuffle = hashlib.blake2b(
+                    repr((self.random_seed, _symbol_keys)).encode(), digest_size=8
+                ).digest()
+                local_rng = random.Random(seed_for_shuffle)
+                local_rng.shuffle(sample_ids)
+                sample_ids = get_data_split(sample_ids, split, split_percentages)
+
+            split_ids[memo_key] = sample_ids
+            return sample_ids
 
         # For negations, we need a cycle of the symbol keys to use for the slash.
         vertical_line_keys = symbol_data.get_similarity_group("latex2e-|")
         negation_cycle = cycle(load_primary_keys(vertical_line_keys))
 
+        def load_strokes(s_id: int) -> list[list[list[int]]]:
+            return ig.unpack_strokes(*self.load_stroke_data(s_id))
+
         # For inside-relations, we need a cycle for circles, squares, and triangles.
         # These need to be filtered for fitness to fit around a symbol.
-        circle_keys = symbol_data.get_similarity_group("latex2e-_bigcirc")
-        square_keys = symbol_data.get_similarity_group("amssymb-_square")
-        triangle_keys = symbol_data.get_similarity_group("latex2e-_bigtriangleup")
+        circle_ids = load_primary_keys(
+            symbol_data.get_similarity_group("latex2e-_bigcirc"),
+            ignore_single_debug_sample_limit=True,
+        )
+        square_ids = load_primary_keys(
+            symbol_data.get_similarity_group("amssymb-_square"),
+            ignore_single_debug_sample_limit=True,
+        )
+        triangle_ids = load_primary_keys(
+            symbol_data.get_similarity_group("latex2e-_bigtriangleup"),
+            ignore_single_debug_sample_limit=True,
+        )
+        if stroke_cache is None:
+            self.cache_stroke_data(circle_ids + square_ids + triangle_ids)
         circle_cycle = cycle(
-            filter(
-                lambda s_id: sc.is_good_circle(self.load_stroke_data(s_id))[0],
-                load_primary_keys(circle_keys, ignore_single_debug_sample_limit=True),
-            )
+            filter(lambda s_id: sc.is_good_circle(load_strokes(s_id))[0], circle_ids)
         )
         square_cycle = cycle(
-            filter(
-                lambda s_id: sc.is_good_square(self.load_stroke_data(s_id))[0],
-                load_primary_keys(square_keys, ignore_single_debug_sample_limit=True),
-            )
+            filter(lambda s_id: sc.is_good_square(load_strokes(s_id))[0], square_ids)
         )
         triangle_cycle = cycle(
-            filter(
-                lambda s_id: sc.is_good_triangle(self.load_stroke_data(s_id))[0],
-                load_primary_keys(triangle_keys, ignore_single_debug_sample_limit=True),
-            )
+            filter(lambda s_id: sc.is_good_triangle(load_strokes(s_id))[0], triangle_ids)
         )
 
         for symbol_key in symbol_data.leaders:
+            similarity_group = frozenset(symbol_data.get_similarity_group(symbol_key))
+            paths = list(symbol_data.all_paths_to_symbol(symbol_key))
 
             samples: list[
                 tuple[
@@ -254,8 +631,7 @@ class StrokeDataset(Dataset):
 
             # Identical values to augmented_symbol_frequency.csv
             real_data_count = sum(
-                len(load_primary_keys(ancestor))
-                for ancestor in symbol_data.all_symbols_to_symbol(symbol_key)
+                len(load_primary_keys(ancestor)) for ancestor in {key for key, _, _ in paths}
             )
             self_symmetry_count = 0
             other_symmetry_count = 0
@@ -263,10 +639,9 @@ class StrokeDataset(Dataset):
             augmentation_count = 0
             inside_count = 0
 
-            for current_key, transformations, composition in symbol_data.all_paths_to_symbol(
-                symbol_key
-            ):
-                for symbol_id in load_primary_keys(current_key):
+            for current_key, transformations, composition in paths:
+                current_ids = load_primary_keys(current_key)
+                for symbol_id in current_ids:
                     # We need to check what composition we have, if any.
                     if composition is None:
                         composition_id = 0
@@ -285,32 +660,33 @@ class StrokeDataset(Dataset):
                         (symbol_id, transformations, (composition, composition_id), None)
                     )
 
-                if current_key in symbol_data.get_similarity_group(symbol_key) and transformations:
+                if current_key in similarity_group and transformations:
                     # If we don't have transformations, those are just similarity taking over
                     # with the identity transform, that counts as real data.
                     # So here, we do have a self-symmetry applied from its similarity group.
-                    self_symmetry_count += len(load_primary_keys(current_key))
+                    self_symmetry_count += len(current_ids)
 
-                if current_key not in symbol_data.get_similarity_group(symbol_key):
-                    other_symmetry_count += len(load_primary_keys(current_key))
+                if current_key not in similarity_group:
+                    other_symmetry_count += len(current_ids)
 
                 if isinstance(composition, st.Negation):
-                    negation_count += len(load_primary_keys(current_key))
+                    negation_count += len(current_ids)
 
                 if isinstance(composition, st.Inside):
-                    inside_count += len(load_primary_keys(current_key))
+                    inside_count += len(current_ids)
 
             # assert samples, f"No samples found for symbol key: {symbol_key}"
 
             # Augment the data to balance the classes.
             if random_augmentation:
                 augmentation_count = augmentation_amount(real_data_count)
-                for _ in range(augmentation_count):
-                    symbol, transformations, composition_tuple, _ = self.rng.choice(samples)
-                    # Use 16 bits of randomness, so as not to overflow the perlin noise algorithm.
-                    samples.append(
-                        (symbol, transformations, composition_tuple, self.rng.randint(0, 2**16 - 1))
-                    )
+                # Draw all picks and seeds at once instead of one Python-level call per sample.
+                picks = self.rng.integers(0, len(samples), size=augmentation_count)
+                # Use 16 bits of randomness, so as not to overflow the perlin noise algorithm.
+                seeds = self.rng.integers(0, 2**16, size=augmentation_count)
+                samples.extend(
+                    (*samples[pick][:3], seed) for pick, seed in zip(picks.tolist(), seeds.tolist())
+                )
 
             if class_limit is not None:
                 samples = samples[:class_limit]
@@ -336,21 +712,85 @@ class StrokeDataset(Dataset):
                         augmentation_count,
                     )
 
-            self.primary_keys.extend(samples)
-            self.symbol_keys.extend([symbol_key] * len(samples))
-
-        conn.close()
+            self.symbol_ranges[symbol_key] = range(
+                len(all_samples), len(all_samples) + len(samples)
+            )
+            all_samples.extend(samples)
+
+        # Store the samples as parallel arrays, which are much cheaper to index and to hand to
+        # the workers than a list of tuples. There are only a handful of distinct symmetries and
+        # compositions, so their matrices are combined once and the samples refer to them by index.
+        sample_count = len(all_samples)
+        self.primary_keys = np.fromiter(
+            (sample[0] for sample in all_samples), dtype=np.int64, count=sample_count
+        )
+        self.composite_ids = np.fromiter(
+            (sample[2][1] for sample in all_samples), dtype=np.int64, count=sample_count
+        )
+        self.augmentation_seeds = np.fromiter(
+            (-1 if sample[3] is None else sample[3] for sample in all_samples),
+            dtype=np.int64,
+            count=sample_count,
+        )
+        self.symmetry_indices = np.full(sample_count, -1, dtype=np.int32)
+        self.composition_indices = np.full(sample_count, -1, dtype=np.int32)
+        self.symmetry_matrices: list[np.ndarray] = []
+        self.compositions: list[tuple[st.Negation | st.Inside, np.ndarray]] = []
+
+        if stroke_cache is None:
+            has_composite = np.fromiter(
+                (sample[2][0] is not None for sample in all_samples),
+                dtype=bool,
+                count=sample_count,
+            )
+            needed_ids = np.union1d(self.primary_keys, self.composite_ids[has_composite])
+            self.cache_stroke_data(needed_ids.tolist())
+
+        symmetry_lookup: dict[tuple[st.Transformation, ...], int] = {}
+        # Negations are keyed by the negation alone, inside relations also by the outer shape.
+        composition_lookup: dict[st.Negation | tuple[st.Inside, int], int] = {}
+        for index, (_, transformations, (composition, composite_id), _) in enumerate(all_samples):
+            if transformations:
+                if transformations not in symmetry_lookup:
+                    symmetry_lookup[transformations] = len(self.symmetry_matrices)
+                    self.symmetry_matrices.append(symmetry_matrix(transformations))
+                self.symmetry_indices[index] = symmetry_lookup[transformations]
+
+            if isinstance(composition, st.Negation):
+                if composition not in composition_lookup:
+                    composition_lookup[composition] = len(self.compositions)
+                    self.compositions.append((composition, negation_matrix(composition)))
+                self.composition_indices[index] = composition_lookup[composition]
+            elif isinstance(composition, st.Inside):
+                if (composition, composite_id) not in composition_lookup:
+                    composition_lookup[(composition, composite_id)] = len(self.compositions)
+                    self.compositions.append(
+                        (composition, inside_matrix(composition, load_strokes(composite_id)))
+                    )
+                self.composition_indices[index] = composition_lookup[(composition, composite_id)]
+
+        # Samples without random augmentation always render to the same image, so they get
+        # a slot in the on-disk image cache, if there is one.
+        deterministic = self.augmentation_seeds < 0
+        self.image_cache_slots = np.full(sample_count, -1, dtype=np.int64)
+        self.image_cache_slots[deterministic] = np.arange(np.count_nonzero(deterministic))
+        self.image_cache_path = None
+        self.image_cache: tuple[np.memmap, np.memmap] | None = None
+        if image_cache_dir is not None:
+            self.image_cache_path = self.create_image_cache(image_cache_dir, deterministic)
+
+        # Each sample refers to its symbol by index, the names are only looked up when needed.
+        self.symbol_keys = list(self.symbol_ranges)
+        self.symbol_indices = np.empty(sample_count, dtype=np.int32)
+        for index, symbol_range in enumerate(self.symbol_ranges.values()):
+            self.symbol_indices[symbol_range.start : symbol_range.stop] = index
 
         # Encode labels into integers
-        self.encoded_labels = label_encoder.transform(self.symbol_keys)
-
-        # Define a transform to convert the images to tensors and normalize them
-        self.transform = transforms.Compose(
-            [
-                transforms.ToTensor(),  # Converts the image to a PyTorch tensor (C, H, W) with values in [0, 1]
-                transforms.Normalize((0.5,), (0.5,)),  # Normalize to range [-1, 1]
-            ]
-        )
+        self.encoded_labels = np.asarray(label_encoder.transform(self.symbol_keys))[
+            self.symbol_indices
+        ]
+        # Indexing a prepared tensor is a lot cheaper than building a new one for each sample.
+        self.label_tensors = torch.as_tensor(np.asarray(self.encoded_labels), dtype=torch.long)
 
     def __len__(self) -> int:
         return len(self.primary_keys)
@@ -359,140 +799,256 @@ class StrokeDataset(Dataset):
         """
         Get the range of indices for a given symbol.
         """
-        start = self.symbol_keys.index(symbol)
-        end = len(self.symbol_keys) - self.symbol_keys[::-1].index(symbol)
-        return range(start, end)
+        return self.symbol_ranges[symbol]
 
     def load_transformed_strokes(self, idx) -> tuple[list[list[tuple[int, int]]], str]:
-        primary_key, required_transforms, (composition, composite_id), random_augmentation_seed = (
-            self.primary_keys[idx]
-        )
-        stroke_data = self.load_stroke_data(primary_key)
-        # If a symmetric character was used, we will need to apply it's transformation.
-        # We may have multiple options here.
-        trans_mats = []
-        for transformation in required_transforms:
-            if transformation.is_rotation:
-                trans_mats.append(ig.rotation_matrix(transformation.angle))
-            else:
-                trans_mats.append(ig.reflection_matrix(transformation.angle))
+        points, offsets = self.load_transformed_points(idx)
+        return ig.unpack_strokes(points, offsets), self.symbol_keys[self.symbol_indices[idx]]
 
-        # Apply the transformations to the stroke data.
-        if trans_mats:
-            stroke_data = ig.apply_transformations(stroke_data, trans_mats)
+    def load_transformed_points(self, idx) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Load the strokes for the given sample with all of its transformations, compositions
+        and augmentations applied, in the packed format of ig.pack_strokes.
+        """
+        points, offsets = self.load_stroke_data(int(self.primary_keys[idx]))
+        # If a symmetric character was used, we will need to apply it's transformation.
+        symmetry_index = self.symmetry_indices[idx]
+        if symmetry_index >= 0:
+            points = ig.apply_transformations_to_points(
+                points, self.symmetry_matrices[symmetry_index]
+            )
 
         # Rescale the image to ensure the rotations and reflections fit within the image bounds.
         # This is necessary to ensure the compositions align correctly.
-        stroke_data, _, _, _ = sp.rescale_and_center_viewport(stroke_data, 1000, 1000)
-
-        # Next, prepare the negation, if any.
-        if isinstance(composition, st.Negation):
-            negation: st.Negation = composition
-            slash_id: int = composite_id
-
-            negation_stroke_data = self.load_stroke_data(slash_id)
-            # Use -y_offset, since the negation views up as positive y, but in the image it's
-            # in the negative y direction.
-            trans_mats = [
-                ig.scale_matrix(negation.scale_factor, negation.scale_factor),
-                ig.rotation_matrix(negation.vert_angle),
-                ig.translation_matrix(negation.x_offset, -negation.y_offset, 1000),
-            ]
-            negation_stroke_data = ig.apply_transformations(negation_stroke_data, trans_mats)
-            stroke_data += negation_stroke_data
-        # Otherwise, prepare the inside relation, if any.
-        elif isinstance(composition, st.Inside):
-            inside: st.Inside = composition
-            outer_id: int = composite_id
-
-            outer_stroke_data = self.load_stroke_data(outer_id)
-            # Find out how large we need to scale the outer symbol to fit the inner symbol.
-            center_x, center_y = 500, 500
-            square_side_length = 1000
-            if inside == st.Inside.Circle:
-                _, square_side_length = sc.is_good_circle(outer_stroke_data)
-            elif inside == st.Inside.Square:
-                _, square_side_length = sc.is_good_square(outer_stroke_data)
-            elif inside == st.Inside.Triangle:
-                _, square_side_length, center_x, center_y = sc.is_good_triangle(outer_stroke_data)
+        points, _, _, _ = sp.rescale_and_center_points(points, 1000, 1000)
+
+        composition_index = self.composition_indices[idx]
+        if composition_index >= 0:
+            composition, composition_matrix = self.compositions[composition_index]
+            composite_id = int(self.composite_ids[idx])
+            # Next, prepare the negation, if any.
+            if isinstance(composition, st.Negation):
+                negation_points, negation_offsets = self.load_stroke_data(composite_id)
+                negation_points = ig.apply_transformations_to_points(
+                    negation_points, composition_matrix
+                )
+                points, offsets = ig.concatenate_strokes(
+                    (points, offsets), (negation_points, negation_offsets)
+                )
+            # Otherwise, prepare the inside relation.
             else:
-                raise ValueError(f"Unknown inside relation: {inside}")
-
-            scale = square_side_length / 1000
-            scale *= 0.9  # Add a 10% margin to fit.
-
-            trans_mats = [
-                ig.scale_matrix(scale, scale),
-                ig.translation_matrix((center_x - 500) / 1000, (center_y - 500) / 1000, 1000),
-            ]
-            stroke_data = ig.apply_transformations(stroke_data, trans_mats)
-            stroke_data += outer_stroke_data
+                points = ig.apply_transformations_to_points(points, composition_matrix)
+                points, offsets = ig.concatenate_strokes(
+                    (points, offsets), self.load_stroke_data(composite_id)
+                )
 
         # Augment the data with a random transformation.
         # The transformation is applied to the strokes before converting them to an image.
         trans_mats = []
-        if random_augmentation_seed is not None:
+        random_augmentation_seed = int(self.augmentation_seeds[idx])
+        if random_augmentation_seed >= 0:
             # Apply some type of random augmentation, using perlin noise 7/10 times.
-            local_rng = random.Random(random_augmentation_seed)
-            operation = local_rng.randint(0, 9)
-            numpy_rng = np.random.RandomState(random_augmentation_seed)
+            # A generator of its own makes the outcome independent of the worker and of the order
+            # in which samples are loaded.
+            sample_rng = np.random.default_rng(random_augmentation_seed)
+            operation = sample_rng.integers(10)
 
             if operation == 0:
-                trans_mats.append(ig.rotation_matrix(numpy_rng.uniform(-5, 5)))
+                trans_mats.append(ig.rotation_matrix(sample_rng.uniform(-5, 5)))
             elif operation == 1:
-                trans_mats.append(
-                    ig.scale_matrix(numpy_rng.uniform(0.9, 1), numpy_rng.uniform(0.9, 1))
-                )
+                trans_mats.append(ig.scale_matrix(*sample_rng.uniform(0.9, 1, size=2)))
             elif operation == 2:
-                trans_mats.append(
-                    ig.skew_matrix(numpy_rng.uniform(-0.1, 0.1), numpy_rng.uniform(-0.1, 0.1))
-                )
+                trans_mats.append(ig.skew_matrix(*sample_rng.uniform(-0.1, 0.1, size=2)))
             else:
-                stroke_data = ig.augment_strokes_with_perlin(
-                    stroke_data, seed=random_augmentation_seed
-                )
+                points = ig.augment_points_with_perlin(points, seed=random_augmentation_seed)
 
         # Apply the transformations to the stroke data.
         if trans_mats:
-            stroke_data = ig.apply_transformations(stroke_data, trans_mats)
+            points = ig.apply_transformations_to_points(points, trans_mats)
 
         # Rescale the image to ensure the rotations and reflections fit within the image bounds.
-        stroke_data, _, _, _ = sp.rescale_and_center_viewport(stroke_data, 1000, 1000)
+        points, _, _, _ = sp.rescale_and_center_points(points, 1000, 1000)
 
-        symbol_key = self.symbol_keys[idx]
-
-        return stroke_data, symbol_key
+        return points, offsets
 
     def __getitem__(self, idx) -> tuple[torch.Tensor, torch.Tensor]:
-        stroke_data, _ = self.load_transformed_strokes(idx)
+        """
+        The image is returned as a raw uint8 tensor (1, H, W), which is a quarter of the size
+        of the normalized float version for the workers to hand over.
+        Batches need to go through normalize_images before they are fed to the model.
+        """
+        if self.image_cache_path is not None and self.image_cache_slots[idx] >= 0:
+            img = self.cached_image(idx)
+        else:
+            points, offsets = self.load_transformed_points(idx)
+            img = ign.points_to_grayscale_image(points, offsets, self.image_size)
 
-        img = ig.strokes_to_grayscale_image(stroke_data, self.image_size)
+        # Add the channel dimension, the image is grayscale.
+        img_tensor = torch.from_numpy(img)[None]
+        return img_tensor, self.label_tensors[idx]  # Return image tensor and label
 
-        # Apply the transform to convert the image to a tensor and normalize it
-        img_tensor = self.transform(img)
-        label_tensor = torch.tensor(
-            self.encoded_labels[idx], dtype=torch.long
-        )  # Convert label to tensor
-        return img_tensor, label_tensor  # Return image tensor and label
+    def create_image_cache(self, image_cache_dir: str | Path, deterministic: np.ndarray) -> Path:
+        """
+        Create the files for the on-disk image cache, unless they already exist.
+        Creating a new cache deletes the stale ones in the same directory.
+        The images are stored in a memory-mapped array with one slot per deterministic sample,
+        next to an array of flags marking the slots that have been rendered.
+        The file name is a hash of everything that goes into these images, including the
+        stroke data and IMAGE_CACHE_VERSION, so a dataset with different samples, drawings,
+        transformations or rendering gets a cache of its own.
+
+        :param image_cache_dir: Directory to keep the cache files in.
+        :param deterministic: Mask of the samples without random augmentation.
+        :return: The path of the image file, the flags have the suffix .done added.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.int64(IMAGE_CACHE_VERSION).tobytes())
+        digest.update(np.int64(self.image_size).tobytes())
+        for array in (
+            self.primary_keys,
+            self.symmetry_indices,
+            self.composition_indices,
+            self.composite_ids,
+        ):
+            digest.update(array[deterministic].tobytes())
+        for matrix in self.symmetry_matrices:
+            digest.update(matrix.tobytes())
+        for _, matrix in self.compositions:
+            digest.update(matrix.tobytes())
+        # The drawings can change in the database without their ids changing.
+        has_composite = deterministic & (self.composition_indices >= 0)
+        stroke_ids = np.union1d(self.primary_keys[deterministic], self.composite_ids[has_composite])
+        for primary_key in stroke_ids.tolist():
+            points, offsets = self.load_stroke_data(primary_key)
+            digest.update(np.int64(primary_key).tobytes())
+            digest.update(np.int64(len(points)).tobytes())
+            digest.update(points.tobytes())
+            digest.update(offsets.tobytes())
+
+        image_cache_path = Path(image_cache_dir) / f"images_{digest.hexdigest()}.u8"
+        slot_count = np.count_nonzero(deterministic)
+        if not image_cache_path.exists() and slot_count:
+            image_cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # Any other cache here belongs to a different database, configuration or renderer.
+            for stale_path in image_cache_path.parent.glob("images_*"):
+                if stale_path.suffix in (".u8", ".done"):
+                    stale_path.unlink(missing_ok=True)
+            # Write the flags first, so that the images file only exists once both are complete.
+            np.memmap(
+                image_cache_path.with_suffix(".done"), dtype=np.uint8, mode="w+", shape=slot_count
+            ).flush()
+            np.memmap(
+                image_cache_path,
+                dtype=np.uint8,
+                mode="w+",
+                shape=(slot_count, self.image_size, self.image_size),
+            ).flush()
+        return image_cache_path
+
+    def cached_image(self, idx: int) -> np.ndarray:
+        """
+        Get the image of a deterministic sample from the image cache, rendering it on a miss.
+        The cache is opened lazily, so that every worker maps it for itself.
+        Workers racing on the same slot write identical images, so no locking is needed.
+        """
+        if self.image_cache is None:
+            images = np.memmap(self.image_cache_path, dtype=np.uint8, mode="r+").reshape(
+                -1, self.image_size, self.image_size
+            )
+            done = np.memmap(self.image_cache_path.with_suffix(".done"), dtype=np.uint8, mode="r+")
+            self.image_cache = images, done
+        images, done = self.image_cache
+
+        slot = self.image_cache_slots[idx]
+        if done[slot]:
+            return np.array(images[slot])
+
+        points, offsets = self.load_transformed_points(idx)
+        img = ign.points_to_grayscale_image(points, offsets, self.image_size)
+        images[slot] = img
+        done[slot] = 1
+        return img
+
+    def __getstate__(self) -> dict:
+        # Memory maps must not be pickled along into spawned workers, they open their own.
+        state = self.__dict__.copy()
+        state["image_cache"] = None
+        return state
+
+    def load_stroke_data(self, primary_key) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Load the packed stroke data for the given sample, see ig.pack_strokes.
+        """
+        return self.stroke_cache[primary_key]
+
+    def cache_stroke_data(self, primary_keys: Iterable[int]) -> None:
+        """
+        Load the packed stroke data for the given samples from the database into the cache.
+        Samples that are already cached are skipped.
+        """
+        missing = self.stroke_cache.missing(primary_keys)
 
-    def load_stroke_data(self, primary_key) -> list[list[tuple[int, int]]]:
-        if self.stroke_cache is not None:
-            return self.stroke_cache[primary_key]
-        # Connect to the SQLite database
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
-
-        # Query the stroke data for the given primary key
-        cursor.execute("SELECT strokes FROM samples WHERE id = ?", (primary_key,))
-        row = cursor.fetchone()
+        rows = []
+        # Query in chunks to stay clear of SQLite's limit on the number of parameters.
+        for start in range(0, len(missing), 500):
+            chunk = missing[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT id, pts_blob, offs_blob FROM samples WHERE id IN ({placeholders})", chunk
+            )
+            rows.extend(cursor.fetchall())
         conn.close()
+        self.stroke_cache.add(rows)
+
+        not_found = self.stroke_cache.missing(missing)
+        if not_found:
+            raise ValueError(f"No stroke data found for primary keys: {not_found}")
 
-        if row is None:
-            raise ValueError(f"No stroke data found for primary key: {primary_key}")
 
-        # Load the stroke data from JSON format
-        stroke_data = json.loads(row[0])
-        return stroke_data
+class StrokeSampleDataset(Dataset):
+    """
+    Hand out the transformed strokes of a StrokeDataset instead of images, so that they can be
+    rasterized a whole batch at a time on the GPU, see training.image_gen_torch.
+    Load it with collate_strokes as the collate_fn.
+    """
+
+    def __init__(self, dataset: StrokeDataset):
+        self.dataset = dataset
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        :return: The points (N, 2), a mask of the points that start a stroke (N,) and the label.
+        """
+        points, offsets = self.dataset.load_transformed_points(idx)
+        stroke_starts = np.zeros(len(points), dtype=bool)
+        # Empty strokes have no point to start with.
+        starts = offsets[:-1]
+        stroke_starts[starts[starts < len(points)]] = True
+        return (
+            torch.from_numpy(points),
+            torch.from_numpy(stroke_starts),
+            self.dataset.label_tensors[idx],
+        )
+
+
+def collate_strokes(
+    batch: list[tuple[torch.Tensor, torch.Tensor, torch.Tensor]],
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Batch the samples of a StrokeSampleDataset for image_gen_torch.rasterize_strokes.
+
+    :param batch: The samples.
+    :return: The points and stroke start mask of all samples concatenated,
+        the number of points of each sample and the labels.
+    """
+    points, stroke_starts, labels = zip(*batch)
+    point_counts = torch.tensor([len(sample_points) for sample_points in points])
+    return torch.cat(points), torch.cat(stroke_starts), point_counts, torch.stack(labels)
 
 
 def recalculate_frequencies():
@@ -758,8 +1314,8 @@ def main():
         split_percentages=split_percentages,
     )
     assert len(test1) == len(test2), "Test datasets should have the same length"
-    assert (
-        test1.primary_keys == test2.primary_keys
+    assert np.array_equal(
+        test1.primary_keys, test2.primary_keys
     ), "Test datasets should have the same primary keys"
 
     # Show all the samples for a given symbol.
@@ -0,0 +1,130 @@
+"""
+A compiled replacement for ig.points_to_grayscale_image, used by the training data loader.
+It draws exactly the same pixels as Pillow's aliased line drawing, which inference relies on,
+so models trained on these images see the same input at inference time.
+"""
+
+import numpy as np
+
+import handtex.detector.image_gen as ig
+
+try:
+    from numba import njit
+
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+
+def points_to_grayscale_image(
+    points: np.ndarray, offsets: np.ndarray, image_size: int
+) -> np.ndarray:
+    """
+    Render the packed strokes (see ig.pack_strokes) to a grayscale image.
+    Falls back to the Pillow renderer if numba isn't installed.
+
+    :param points: Array of shape (N, 2) with the points of all strokes, in 0-1000 space.
+    :param offsets: Array of shape (S + 1,) with the stroke boundaries.
+    :param image_size: Size of the generated image (the image is square).
+    :return: The image as a uint8 array, black strokes on a white background.
+    """
+    if not HAVE_NUMBA:
+        return ig.points_to_grayscale_image(points, offsets, image_size)
+
+    # Scale down the strokes to fit the image size, adding an extra 5% padding.
+    padding = 0.10
+    scale = (image_size * (1 - padding)) / 1000
+    offset = (image_size * padding) / 2
+    pixels = np.round(points * scale + offset).astype(np.int64)
+
+    image = np.full((image_size, image_size), 255, dtype=np.uint8)
+    _draw_strokes(image, pixels, offsets.astype(np.int64))
+    return image
+
+
+@njit(cache=True)
+def _draw_point(image: np.ndarray, x: int, y: int) -> None:
+    if 0 <= x < image.shape[1] and 0 <= y < image.shape[0]:
+        image[y, x] = 0
+
+
+@njit(cache=True)
+def _draw_line(image: np.ndarray, x0: int, y0: int, x1: int, y1: int) -> None:
+    """
+    Bresenham line from (x0, y0) up to, but excluding, (x1, y1), like Pillow's line8.
+    """
+    dx = x1 - x0
+    xs = 1
+    if dx < 0:
+        dx = -dx
+        xs = -1
+    dy = y1 - y0
+    ys = 1
+    if dy < 0:
+        dy = -dy
+        ys = -1
+
+    if dx == 0:
+        # Vertical
+        for _ in range(dy):
+            _draw_point(image, x0, y0)
+            y0 += ys
+    elif dy == 0:
+        # Horizontal
+        for _ in range(dx):
+            _draw_point(image, x0, y0)
+            x0 += xs
+    elif dx > dy:
+        # Horizontal slope
+        e = 2 * dy - dx
+        for _ in range(dx):
+            _draw_point(image, x0, y0)
+            if e >= 0:
+                y0 += ys
+                e -= 2 * dx
+            e += 2 * dy
+            x0 += xs
+    else:
+        # Vertical slope
+        e = 2 * dx - dy
+        for _ in range(dy):
+            _draw_point(image, x0, y0)
+            if e >= 0:
+                x0 += xs
+                e -= 2 * dy
+            e += 2 * dx
+            y0 += ys
+
+
+@njit(cache=True)
+def _draw_strokes(image: np.ndarray, pixels: np.ndarray, offsets: np.ndarray) -> None:
+    for stroke in range(offsets.shape[0] - 1):
+        start = offsets[stroke]
+        end = offsets[stroke + 1]
+        if start == end:
+            continue
+
+        x0 = pixels[start, 0]
+        y0 = pixels[start, 1]
+        single_point = True
+        for i in range(start + 1, end):
+            x1 = pixels[i, 0]
+            y1 = pixels[i, 1]
+            # Skip duplicate consecutive points, so that they can be detected as single points.
+            if x1 == x0 and y1 == y0:
+                continue
+            _draw_line(image, x0, y0, x1, y1)
+            x0 = x1
+            y0 = y1
+            single_point = False
+
+        if single_point:
+            # Handle single point by adding a second point offset by 1
+            _draw_line(image, x0, y0, x0 + 1, y0 + 1)
+            x0 += 1
+            y0 += 1
+        # Pillow finishes every polyline by drawing its last point.
+        _draw_point(image, x0, y0)
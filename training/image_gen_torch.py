@@ -0,0 +1,84 @@
+"""
+A batched torch version of ig.points_to_grayscale_image, so that a whole batch of strokes
+can be rasterized on the GPU instead of in the dataloader workers.
+Like training.image_gen_numba, it draws exactly the same pixels as Pillow's aliased lines.
+
+Use StrokeSampleDataset and collate_strokes from training.data_loader to load the strokes,
+as training.train does with --rasterize-on-device.
+"""
+
+import torch
+
+
+def rasterize_strokes(
+    points: torch.Tensor, stroke_starts: torch.Tensor, point_counts: torch.Tensor, image_size: int
+) -> torch.Tensor:
+    """
+    Render a batch of strokes to grayscale images.
+    The points of all samples are concatenated, this layout can simply be concatenated
+    again to join batches.
+
+    :param points: Tensor of shape (N, 2) with the points of all samples, in 0-1000 space.
+    :param stroke_starts: Bool tensor of shape (N,), True for the first point of each stroke,
+        which includes the first point of each sample.
+    :param point_counts: Tensor of shape (B,) with the number of points of each sample.
+    :param image_size: Size of the generated images (images are square).
+    :return: The images as a uint8 tensor (B, 1, H, W), black strokes on a white background.
+    """
+    device = points.device
+    batch_size = len(point_counts)
+    images = torch.full(
+        (batch_size * image_size * image_size,), 255, dtype=torch.uint8, device=device
+    )
+    if len(points) == 0:
+        return images.view(batch_size, 1, image_size, image_size)
+
+    # Scale down the strokes to fit the image size, adding an extra 5% padding.
+    padding = 0.10
+    scale = (image_size * (1 - padding)) / 1000
+    offset = (image_size * padding) / 2
+    pixels = torch.round(points.double() * scale + offset).long()
+    samples = torch.repeat_interleave(torch.arange(batch_size, device=device), point_counts)
+    stroke_ids = torch.cumsum(stroke_starts.long(), 0) - 1
+
+    # Each point is connected to the next one, unless that starts a new stroke.
+    connected = ~stroke_starts[1:]
+    segment_starts = pixels[:-1][connected]
+    deltas = pixels[1:][connected] - segment_starts
+    segment_samples = samples[:-1][connected]
+    segment_strokes = stroke_ids[:-1][connected]
+
+    # Bresenham lines, excluding the end point, like Pillow's line8.
+    # Step k along the major axis moves floor((2 * minor * k + major) / (2 * major))
+    # along the minor one, which is what the error term of the loop works out to.
+    lengths = deltas.abs().amax(dim=1)
+    majors = lengths.repeat_interleave(lengths)
+    minors = deltas.abs().amin(dim=1).repeat_interleave(lengths)
+    steps = torch.arange(len(majors), device=device) - torch.repeat_interleave(
+        torch.cumsum(lengths, 0) - lengths, lengths
+    )
+    minor_steps = torch.div(2 * minors * steps + majors, 2 * majors, rounding_mode="floor")
+    # Pillow treats diagonals as vertical slopes, but they step the same either way.
+    x_major = (deltas[:, 0].abs() > deltas[:, 1].abs()).repeat_interleave(lengths)
+    directions = deltas.sign().repeat_interleave(lengths, dim=0)
+    line_pixels = segment_starts.repeat_interleave(lengths, dim=0)
+    line_pixels[:, 0] += directions[:, 0] * torch.where(x_major, steps, minor_steps)
+    line_pixels[:, 1] += directions[:, 1] * torch.where(x_major, minor_steps, steps)
+    line_samples = segment_samples.repeat_interleave(lengths)
+
+    # Pillow finishes every polyline by drawing its last point.
+    # Strokes that collapsed to a single pixel are drawn as a line to (+1, +1) instead.
+    stroke_ends = torch.ones_like(stroke_starts)
+    stroke_ends[:-1] = stroke_starts[1:]
+    single_point = torch.ones(int(stroke_ids[-1]) + 1, dtype=torch.bool, device=device)
+    single_point[segment_strokes[lengths > 0]] = False
+    end_pixels = pixels[stroke_ends] + single_point[:, None]
+    end_samples = samples[stroke_ends]
+
+    all_pixels = torch.cat((line_pixels, end_pixels, pixels[stroke_ends][single_point]))
+    all_samples = torch.cat((line_samples, end_samples, end_samples[single_point]))
+    x, y = all_pixels[:, 0], all_pixels[:, 1]
+    inside = (x >= 0) & (x < image_size) & (y >= 0) & (y < image_size)
+    flat_indices = (all_samples * image_size + y) * image_size + x
+    images[flat_indices[inside]] = 0
+    return images.view(batch_size, 1, image_size, image_size)
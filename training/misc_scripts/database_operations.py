@@ -83,7 +83,7 @@ output_cursor.execute(
 output_cursor.execute("CREATE INDEX key_index ON samples (key)")
 
 # Fetch all rows from the resampled database
-input_cursor.execute("SELECT * FROM samples")
+input_cursor.execute("SELECT id, key, strokes FROM samples")
 rows = input_cursor.fetchall()
 
 
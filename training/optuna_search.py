@@ -3,7 +3,6 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from sklearn.preprocessing import LabelEncoder
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 # Import your modules.
@@ -14,6 +13,8 @@ from training.data_loader import (
     DataSplit,
     recalculate_frequencies,
     build_stroke_cache,
+    create_dataloader,
+    normalize_images,
 )
 from training.hyperparameters import batch_size
 from training import database
@@ -33,6 +34,9 @@ label_encoder.fit(symbol_data.leaders)
 recalculate_frequencies()
 db_path = ut.resource_path(database, "handtex.db")
 stroke_cache = build_stroke_cache(db_path)
+# Images of samples without random augmentation are rendered once and then reused.
+# Each dataset keeps its cache in a directory of its own, replacing the stale one in there.
+image_cache_dir = ut.get_cache_path() / "image_cache" / "optuna"
 
 class_limit_factor = 20
 seed = 0
@@ -60,6 +64,7 @@ train_dataset = StrokeDataset(
     split_percentages=split_percentages,
     class_limit=5 * class_limit_factor,
     stroke_cache=stroke_cache,
+    image_cache_dir=image_cache_dir / "train",
 )
 validation_dataset = StrokeDataset(
     db_path,
@@ -71,6 +76,7 @@ validation_dataset = StrokeDataset(
     split_percentages=split_percentages,
     class_limit=2 * class_limit_factor,
     stroke_cache=stroke_cache,
+    image_cache_dir=image_cache_dir / "validation",
 )
 test_dataset = StrokeDataset(
     db_path,
@@ -82,13 +88,12 @@ test_dataset = StrokeDataset(
     split_percentages=split_percentages,
     class_limit=3 * class_limit_factor,
     stroke_cache=stroke_cache,
+    image_cache_dir=image_cache_dir / "test",
 )
 
-train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4)
-validation_dataloader = DataLoader(
-    validation_dataset, batch_size=batch_size, shuffle=False, num_workers=4
-)
-test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+train_dataloader = create_dataloader(train_dataset, batch_size, shuffle=True)
+validation_dataloader = create_dataloader(validation_dataset, batch_size, shuffle=False)
+test_dataloader = create_dataloader(test_dataset, batch_size, shuffle=False)
 
 ###############################################################################
 # Define a dynamic CNN model function for NAS/hyperparameter search.
@@ -185,7 +190,8 @@ def objective(trial: optuna.trial.Trial) -> float:
         for data, targets in tqdm(
             train_dataloader, desc=f"Trial {trial.number} Epoch {epoch+1}/{num_epochs}"
         ):
-            data, targets = data.to(device), targets.to(device)
+            data = normalize_images(data.to(device, non_blocking=True))
+            targets = targets.to(device, non_blocking=True)
             optimizer.zero_grad()
             outputs = model(data)
             loss = criterion(outputs, targets)
@@ -203,7 +209,8 @@ def objective(trial: optuna.trial.Trial) -> float:
         total = 0
         with torch.no_grad():
             for data, targets in validation_dataloader:
-                data, targets = data.to(device), targets.to(device)
+                data = normalize_images(data.to(device, non_blocking=True))
+                targets = targets.to(device, non_blocking=True)
                 outputs = model(data)
                 loss = criterion(outputs, targets)
                 val_running_loss += loss.item() * data.size(0)
@@ -295,7 +302,8 @@ if __name__ == "__main__":
 
     with torch.no_grad():
         for data, targets in test_dataloader:
-            data, targets = data.to(device), targets.to(device)
+            data = normalize_images(data.to(device, non_blocking=True))
+            targets = targets.to(device, non_blocking=True)
             outputs = final_model(data)
             loss = criterion(outputs, targets)
             test_running_loss += loss.item() * data.size(0)
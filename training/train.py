@@ -4,7 +4,6 @@ import torch
 from safetensors.torch import save_file
 from sklearn.preprocessing import LabelEncoder
 from torch import nn
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from collections import Counter
 
@@ -21,11 +20,17 @@ from training.hyperparameters import (
 from handtex.detector.image_gen import IMAGE_SIZE
 from training.data_loader import (
     StrokeDataset,
+    StrokeSampleDataset,
+    ChunkedDataLoader,
     DataSplit,
     recalculate_frequencies,
     build_stroke_cache,
+    create_dataloader,
+    collate_strokes,
+    normalize_images,
 )
 from training import database
+from training.image_gen_torch import rasterize_strokes
 from handtex.detector.model import CNN
 
 
@@ -56,7 +61,46 @@ def save_encoder(label_encoder: LabelEncoder, leader_keys: list[str]):
         file.write(encoding_str)
 
 
-def main(resume_from_checkpoint=False):
+def make_dataloader(
+    dataset: StrokeDataset, shuffle: bool, rasterize_on_device: bool
+) -> ChunkedDataLoader:
+    """
+    Create the dataloader for a dataset.
+
+    :param dataset: The dataset to load from.
+    :param shuffle: Whether to reshuffle the samples every epoch.
+    :param rasterize_on_device: If True, the workers only hand out the strokes,
+        which are then rasterized on the device, see batch_to_device.
+    :return: The dataloader.
+    """
+    if rasterize_on_device:
+        return create_dataloader(
+            StrokeSampleDataset(dataset), batch_size, shuffle, collate_fn=collate_strokes
+        )
+    return create_dataloader(dataset, batch_size, shuffle)
+
+
+def batch_to_device(
+    batch: list[torch.Tensor], device: str, rasterize_on_device: bool
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Move a batch from a dataloader of make_dataloader to the device.
+
+    :param batch: The batch.
+    :param device: The device to move it to.
+    :param rasterize_on_device: Whether the batch holds strokes to rasterize on the device.
+    :return: The normalized images and the targets.
+    """
+    batch = [tensor.to(device, non_blocking=True) for tensor in batch]
+    if rasterize_on_device:
+        points, stroke_starts, point_counts, targets = batch
+        images = rasterize_strokes(points, stroke_starts, point_counts, IMAGE_SIZE)
+    else:
+        images, targets = batch
+    return normalize_images(images), targets
+
+
+def main(resume_from_checkpoint=False, rasterize_on_device=False):
     symbol_data = sr.SymbolData()
     num_classes = len(symbol_data.leaders)
 
@@ -66,6 +110,17 @@ def main(resume_from_checkpoint=False):
     recalculate_frequencies()
     db_path = ut.resource_path(database, "handtex.db")
     stroke_cache = build_stroke_cache(db_path)
+    # Images of samples without random augmentation are rendered once and then reused.
+    # Each dataset keeps its cache in a directory of its own, replacing the stale one in there.
+    # Rasterizing on the device doesn't use the images.
+    image_cache_dirs = {
+        split: (
+            None
+            if rasterize_on_device
+            else ut.get_cache_path() / "image_cache" / "training" / split.name.lower()
+        )
+        for split in DataSplit
+    }
 
     random_seed = 11
 
@@ -97,6 +152,7 @@ def main(resume_from_checkpoint=False):
         split_percentages=split_percentages,
         class_limit=200,
         stroke_cache=stroke_cache,
+        image_cache_dir=image_cache_dirs[DataSplit.TRAIN],
     )
     validation_dataset = StrokeDataset(
         db_path,
@@ -108,6 +164,7 @@ def main(resume_from_checkpoint=False):
         split_percentages=split_percentages,
         class_limit=40,
         stroke_cache=stroke_cache,
+        image_cache_dir=image_cache_dirs[DataSplit.VALIDATION],
     )
     test_dataset = StrokeDataset(
         db_path,
@@ -119,13 +176,14 @@ def main(resume_from_checkpoint=False):
         split_percentages=split_percentages,
         class_limit=50,
         stroke_cache=stroke_cache,
+        image_cache_dir=image_cache_dirs[DataSplit.TEST],
     )
 
     # Create dataloaders.
     # For training we shuffle, but for validation/test we use shuffle=False.
-    train_dataloader = DataLoader(train_dataset, batch_size, shuffle=True, num_workers=4)
-    validation_dataloader = DataLoader(validation_dataset, batch_size, shuffle=False, num_workers=4)
-    test_dataloader = DataLoader(test_dataset, batch_size, shuffle=False, num_workers=4)
+    train_dataloader = make_dataloader(train_dataset, True, rasterize_on_device)
+    validation_dataloader = make_dataloader(validation_dataset, False, rasterize_on_device)
+    test_dataloader = make_dataloader(test_dataset, False, rasterize_on_device)
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
     model = CNN(num_classes=num_classes, image_size=IMAGE_SIZE).to(device)
@@ -169,9 +227,8 @@ def main(resume_from_checkpoint=False):
         correct = 0
         total = 0
 
-        for data, targets in tqdm(train_dataloader, desc="Training"):
-            data = data.to(device)
-            targets = targets.to(device)
+        for batch in tqdm(train_dataloader, desc="Training"):
+            data, targets = batch_to_device(batch, device, rasterize_on_device)
 
             scores = model(data)
             loss = criterion(scores, targets)
@@ -201,9 +258,8 @@ def main(resume_from_checkpoint=False):
         val_targets = []
 
         with torch.no_grad():
-            for data, targets in validation_dataloader:
-                data = data.to(device)
-                targets = targets.to(device)
+            for batch in validation_dataloader:
+                data, targets = batch_to_device(batch, device, rasterize_on_device)
                 outputs = model(data)
                 loss = criterion(outputs, targets)
                 val_running_loss += loss.item() * data.size(0)
@@ -229,9 +285,8 @@ def main(resume_from_checkpoint=False):
         test_targets = []
 
         with torch.no_grad():
-            for data, targets in test_dataloader:
-                data = data.to(device)
-                targets = targets.to(device)
+            for batch in test_dataloader:
+                data, targets = batch_to_device(batch, device, rasterize_on_device)
                 outputs = model(data)
                 loss = criterion(outputs, targets)
                 test_running_loss += loss.item() * data.size(0)
@@ -306,9 +361,8 @@ def main(resume_from_checkpoint=False):
     final_test_preds = []
     final_test_targets = []
     with torch.no_grad():
-        for data, targets in test_dataloader:
-            data = data.to(device)
-            targets = targets.to(device)
+        for batch in test_dataloader:
+            data, targets = batch_to_device(batch, device, rasterize_on_device)
             outputs = model(data)
             _, predicted = torch.max(outputs.data, 1)
             final_test_preds.extend(predicted.cpu().numpy())
@@ -356,6 +410,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--resume", action="store_true", help="Resume training from the latest checkpoint."
     )
+    parser.add_argument(
+        "--rasterize-on-device",
+        action="store_true",
+        help="Rasterize the strokes in batches on the GPU instead of in the dataloader workers.",
+    )
     args = parser.parse_args()
 
-    main(resume_from_checkpoint=args.resume)
+    main(resume_from_checkpoint=args.resume, rasterize_on_device=args.rasterize_on_device)